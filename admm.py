@@ -1,10 +1,123 @@
 #!/usr/bin/env python3
 
+import time
+import multiprocessing
+
 import numpy as np
+import scipy.sparse as sp
 from scipy.optimize import fmin_slsqp, fmin_ncg, least_squares
 
+from numsolver import interior_point, path_min
+
 def safedot(A, x):
-    return np.dot(A, x)
+    return A.dot(x)
+
+def norm(x):
+    return np.sqrt(np.dot(x, x))
+
+def prox_utility(b, mu, w, alpha, x0=None, niter=50):
+    """
+    Solve the proximal step of the alpha-fair utilities
+
+        argmin_x -w * U(x) + b * x + mu / 2 * x^2
+
+    element-wise, i.e. the positive root of mu * x + b = w * x^-alpha.
+
+    It is closed-form for alpha = 1. Otherwise the left hand side minus the
+    right hand side is increasing in x, and the root is found by newton
+    steps safeguarded by bisection on [0, hi], all flows at once.
+    """
+    b = np.asarray(b, dtype=float)
+    w = np.broadcast_to(np.asarray(w, dtype=float), b.shape)
+    alpha = np.broadcast_to(np.asarray(alpha, dtype=float), b.shape)
+
+    # The root of mu * x^2 + b * x - w = 0, in a stable form
+    sq = np.sqrt(b * b + 4 * mu * w)
+    x = np.where(b < 0, (sq - b) / (2 * mu),
+                 2 * w / np.where(b + sq > 0, b + sq, 1))
+
+    log_mask = alpha == 1
+    if np.all(log_mask):
+        return x
+
+    idx = np.flatnonzero(~log_mask)
+    b, w, a = b[idx], w[idx], alpha[idx]
+    lo = np.zeros(len(idx))
+    hi = np.maximum(-b / mu, 0) + np.power(w / mu, 1 / (1 + a))
+    if x0 is None:
+        y = hi
+    else:
+        y = np.asarray(x0, dtype=float)[idx]
+        y = np.where(y > 0, np.minimum(y, hi), hi)
+    for i in range(niter):
+        wy = w * np.power(y, -a)
+        phi = mu * y + b - wy
+        lo = np.where(phi < 0, y, lo)
+        hi = np.where(phi > 0, y, hi)
+        step = phi / (mu + a * wy / y)
+        if np.all(np.abs(step) <= 1e-10 * y):
+            break
+        y_new = y - step
+        y = np.where((y_new > lo) & (y_new < hi), y_new, (lo + hi) / 2)
+    x[idx] = y
+    return x
+
+class Anderson(object):
+    """
+    Type-II Anderson acceleration of a fixed point iteration v <- T(v)
+
+    The next point extrapolates the last `memory` points and their images.
+    It is safeguarded: if the fixed point residual T(v) - v grows after an
+    extrapolation, the extrapolated point is dropped for the plain image of
+    the point before it, and the memory is cleared.
+    """
+
+    def __init__(self, memory, reg=1e-10):
+        self.memory = memory
+        self.reg = reg
+        self.accepted = 0
+        self.rejected = 0
+        self.reset()
+
+    def reset(self):
+        self.v = None
+        self.g = None
+        self.gn = None
+        self.dV = []
+        self.dG = []
+        self.safe = None
+
+    def step(self, v, Tv):
+        """
+        Return the next point, given the last point v and its image Tv.
+        """
+        g = Tv - v
+        gn = norm(g)
+        if self.safe is not None and gn > self.gn:
+            safe = self.safe
+            self.rejected += 1
+            self.reset()
+            return safe
+
+        if self.v is not None:
+            self.dV.append(v - self.v)
+            self.dG.append(g - self.g)
+            if len(self.dV) > self.memory:
+                self.dV.pop(0)
+                self.dG.pop(0)
+        self.v, self.g, self.gn = v, g, gn
+        if not self.dV:
+            self.safe = None
+            return Tv
+
+        dV = np.column_stack(self.dV)
+        dG = np.column_stack(self.dG)
+        H = dG.T.dot(dG)
+        H += self.reg * max(np.trace(H), 1e-30) * np.eye(len(H))
+        gamma = np.linalg.solve(H, dG.T.dot(g))
+        self.safe = Tv
+        self.accepted += 1
+        return Tv - (dV + dG).dot(gamma)
 
 class ADMM(object):
     """
@@ -17,34 +130,97 @@ class ADMM(object):
     f: a multi-dimension function, should return an array of results
     argmin_f: the method to optimize x, see argmin_f() below for signature
     argmin_g: the method to optimize z, see argmin_g() below for signature
-    A: the constraint matrix
+    A: the constraint matrix, dense or scipy.sparse
     c: the constraint
     rho: something like a step size
+    eps_abs, eps_rel: the absolute and relative tolerances on the primal and
+                      dual residuals
+
+    The iterations can be accelerated by:
+    relax: the over-relaxation factor, usually in [1.5, 1.8] (default: 1,
+           no relaxation)
+    anderson: the memory of the Anderson acceleration of the (z, u) fixed
+              point (default: 0, disabled)
+    adaptive: adapt rho to balance the primal and dual residuals
+
+    After solve(), stats holds the mode, the number of iterations and the
+    wall time.
     """
 
-    def __init__(self, f, argmin_f, argmin_g, A, c, rho=1):
+    def __init__(self, f, argmin_f, argmin_g, A, c, rho=1, eps_abs=1e-6,
+                 eps_rel=1e-4, relax=1.0, anderson=0, adaptive=False):
         self.M, self.N = A.shape
         assert self.M == len(c)
 
         self.f = f
 
         self.argmin_f = argmin_f
-        self.A = np.array(A)
-        self.AT = self.A.T
+        if sp.issparse(A):
+            self.A = sp.csr_matrix(A, dtype=float)
+            self.AT = self.A.T.tocsr()
+            self.B = sp.identity(self.M, format='csr')
+        else:
+            self.A = np.array(A, dtype=float)
+            self.AT = self.A.T
+            self.B = np.eye(self.M)
+        self.BT = self.B
 
         self.argmin_g = argmin_g
-        self.B = np.eye(self.M)
-        self.BT = np.eye(self.M)
 
-        self.c = np.array(c)
+        self.c = np.array(c, dtype=float)
 
         self.x = np.zeros(self.N)
         self.z = np.zeros(self.M)
         self.u = np.zeros(self.M)
+        self.Ax = np.zeros(self.M)
 
         self.rho = rho
+        self.eps_abs = eps_abs
+        self.eps_rel = eps_rel
+        self.inner = inner
+
+        self.relax = relax
+        self.anderson = anderson
+        self.adaptive = adaptive
+        self.stats = {}
+
+    def mode(self):
+        modes = []
+        if self.relax != 1:
+            modes.append('relax=%g' % self.relax)
+        if self.anderson:
+            modes.append('anderson=%d' % self.anderson)
+        if self.adaptive:
+            modes.append('adaptive')
+        return '+'.join(modes) or 'plain'
+
+    def state(self):
+        """
+        The state of the fixed point iteration, for Anderson acceleration.
+        """
+        return np.concatenate((self.z, self.u))
+
+    def set_state(self, v):
+        self.z, self.u = v[:self.M], v[self.M:]
+
+    def update_rho(self, e, mu=10, tau=2):
+        """
+        Residual balancing: scale rho up when the primal residual dominates
+        and down when the dual residual does. Return the factor.
+        """
+        r, s = e
+        if r > mu * s:
+            self.rho *= tau
+            return tau
+        if s > mu * r:
+            self.rho /= tau
+            return 1 / tau
+        return 1
 
     def iterate(self):
+        """
+        Run one iteration, return the norms of the primal and dual residuals.
+        """
         x, z, u = self.x, self.z, self.u
         A, B = self.A, self.B
         AT, BT = self.AT, self.BT
@@ -54,142 +230,443 @@ class ADMM(object):
         f = self.f
 
         # iterate x
-        v = [c[i] - safedot(B[i], z) for i in range(M)]
-        xk = self.argmin_f(f, rho, A, AT, u, np.array(v))
+        v = c - safedot(B, z)
+        xk = self.argmin_f(f, rho, A, AT, u, v)
+        Ax = safedot(A, xk)
+
+        # over-relaxation
+        Ax_hat = self.relax * Ax + (1 - self.relax) * v
 
         # iterate z
-        w = [c[i] - safedot(A[i], xk) for i in range(M)]
-        zk = self.argmin_g(rho, B, BT, u, np.array(w))
+        w = c - Ax_hat
+        zk = self.argmin_g(rho, B, BT, u, w)
 
         # iterate u
-        delta = [c[i] - np.dot(B[i], zk) - np.dot(A[i], xk) for i in range(M)]
-        uk = u - rho * np.array(delta)
-
-        e = max(((self.x - xk)/xk)**2)
-        self.x, self.z, self.u = xk, zk, uk
-        return e
+        Bz = safedot(B, zk)
+        uk = u - rho * (c - Bz - Ax_hat)
+
+        s = rho * norm(safedot(AT, safedot(B, zk - z)))
+        self.x, self.z, self.u, self.Ax = xk, zk, uk, Ax
+        return norm(c - Bz - Ax), s
+
+    def converged(self, e):
+        """
+        The stopping criterion of Boyd et al. on the residuals e = (r, s)
+        """
+        r, s = e
+        eps_pri = np.sqrt(self.M) * self.eps_abs + \
+            self.eps_rel * max(norm(self.Ax), norm(self.z), norm(self.c))
+        eps_dual = np.sqrt(self.N) * self.eps_abs + \
+            self.eps_rel * norm(safedot(self.AT, self.u))
+        return r <= eps_pri and s <= eps_dual
 
     def dump(self):
-        print(sum(self.f(self.x)))
+        # f may be the utility of each flow or already their sum
+        print(np.sum(self.f(self.x)))
         print("x=", self.x)
         print("z=", self.z)
         print("u=", self.u)
 
     def solve(self, niter, step=1, debug=False):
+        start = time.time()
+        aa = Anderson(self.anderson) if self.anderson else None
+        i = 0
+        done = False
         for i in range(niter):
+            v = self.state()
             e = self.iterate()
             if debug:
                 if (i+1) % step == 0:
                     self.dump()
                     print(e)
-            if e < 1e-4:
+            done = self.converged(e)
+            if done:
                 break
+            if self.adaptive and self.update_rho(e) != 1 and aa is not None:
+                # The fixed point map changed with rho
+                aa.reset()
+            if aa is not None:
+                self.set_state(aa.step(v, self.state()))
+
+        self.stats = {'mode': self.mode(), 'iterations': i + 1,
+                      'time': time.time() - start, 'converged': done}
+        if aa is not None:
+            self.stats['accepted'] = aa.accepted
+            self.stats['rejected'] = aa.rejected
         if debug:
             self.dump()
+            print('%(mode)s: %(iterations)d iterations in %(time).3fs'
+                  % self.stats)
         return self.x, self.z, self.u
 
 class FullADMM(ADMM):
+    """
+    Linearized ADMM for the alpha-fair NUM problem
 
-    def __init__(self, f, A, c, rho=1):
-        ADMM.__init__(self, f, None, None, A, c, rho)
-
-    def update_x(self, f, rho, A, AT, u, c):
-        N = self.N
-        xs = np.array(self.x)
-        uTA = [np.dot(AT[i], u) for i in range(N)]
-
-        for i in range(N):
-            xi = xs[i]
-
-            aa = np.dot(AT[i], AT[i])
-            _a = rho * aa
-            _b = uTA[i] - rho * (np.dot(AT[i], c) + aa * xi)
-            _c = -1
-            dx = lambda _x: _a * _x + _b + _c / _x
-
-            xs[i] = max(0, (-_b + np.sqrt(_b**2 - 4 * _a * _c))/(2*_a))
-
-            sq = lambda _x: np.array(AT[i] * (_x - xi) - c)
-            pr = lambda _sqx: np.dot(u, _sqx) + rho / 2 * sum(_sqx**2)
-            obj = lambda _x: -f(_x) + pr(sq(_x))
-
-            fprime = lambda _x: -1/np.maximum(_x, 1e-4)
-            pprime = lambda _x: uTA[i]
-            ppprime = lambda _sqx: np.array(np.dot(AT[i], _sqx))
-            jac = lambda _x: fprime(_x) + pprime(_x) + rho * ppprime(sq(_x))
-
-
-            xsi = fmin_slsqp(obj, np.ones(1), fprime=jac,
-                             bounds=[(1e-3, np.inf)], disp=0)
-            if xs[i] - xsi > 1e-2:
-                print("error:", xs[i], xsi)
-            c += AT[i] * (xi - xs[i])
-
-        return xs
-
-    def update_z(self, rho, B, BT, u, c):
-        M = len(B)
-        xs = np.array(self.z)
+        max sum(w * U(x))
+           Ax + z = c, z >= 1e-4
 
-        uTB = u
+    The quadratic penalty of the x step is linearized around the last x
+    with the proximal weight mu >= rho * ||A||^2, which makes the x step
+    separable and closed-form in each flow (see prox_utility). The z step
+    is a projection.
 
-        for i in range(M):
-            xi = xs[i]
-            sq = lambda _x: (_x - xi) - c[i]
-            pr = lambda _x: u[i] * _x + rho / 2 * sum(_x**2)
-            obj = lambda _x: pr(sq(_x))
+    f: the objective printed by dump(), it does not change the steps
+    alpha, w: the alpha and the weight of each flow (default: all ones, i.e.
+              proportional fairness)
+    mu: the proximal weight (default: rho * ||A||_1 * ||A||_inf, an upper
+        bound of rho * ||A||^2), scaled with rho by the adaptive mode
 
-            pprime = lambda _x: uTB[i]
-            ppprime = lambda _sqx: _sqx
-            jac = lambda _x: pprime(_x) + rho * ppprime(sq(_x))
+    The state accelerated by Anderson is (x, z, u), since the linearized x
+    step depends on the last x.
+    """
 
-            xs[i] = fmin_slsqp(obj, np.zeros(1), fprime=jac,
-                               bounds=[(1e-4, np.inf)], iter=10, disp=0)
-            c += (xi - xs[i])
-        return xs
+    def __init__(self, f, A, c, rho=1, alpha=None, w=None, mu=None,
+                 eps_abs=1e-6, eps_rel=1e-4, relax=1.0, anderson=0,
+                 adaptive=False):
+        ADMM.__init__(self, f, None, None, A, c, rho, eps_abs, eps_rel,
+                      relax, anderson, adaptive)
+        N = self.N
+        self.alpha = np.ones(N) if alpha is None else \
+            np.asarray(alpha, dtype=float)
+        self.w = np.ones(N) if w is None else np.asarray(w, dtype=float)
+        absA = abs(self.A)
+        width = np.max(absA.sum(axis=1))
+        if mu is None:
+            mu = rho * np.max(absA.sum(axis=0)) * width
+        self.mu = max(mu, 1e-12)
+
+        # Start from the capacity of the most shared link split evenly
+        self.x = np.ones(N) * np.min(self.c) / max(width, 1)
+        self.Ax = safedot(self.A, self.x)
+        self.z = np.maximum(self.c - self.Ax, 1e-4)
+
+    def state(self):
+        return np.concatenate((self.x, self.z, self.u))
+
+    def set_state(self, v):
+        N, M = self.N, self.M
+        # The flows must stay positive for the utilities
+        self.x = np.maximum(v[:N], 1e-12)
+        self.z, self.u = v[N:N+M], v[N+M:]
+        self.Ax = safedot(self.A, self.x)
+
+    def update_rho(self, e, mu=10, tau=2):
+        factor = ADMM.update_rho(self, e, mu, tau)
+        self.mu *= factor
+        return factor
+
+    def update_x(self, u, r):
+        # Linearize rho/2 * ||Ax + z - c||^2 at the current x, r = Ax + z - c
+        g = safedot(self.AT, u + self.rho * r)
+        return prox_utility(g - self.mu * self.x, self.mu, self.w,
+                            self.alpha, self.x)
+
+    def update_z(self, u, w):
+        # argmin u * z + rho/2 * (z - w)^2 over z >= 1e-4, w = c - Ax
+        return np.maximum(w - u / self.rho, 1e-4)
 
     def iterate(self):
         x, z, u = self.x, self.z, self.u
-        A, B = self.A, self.B
-        AT, BT = self.AT, self.BT
+        A, AT = self.A, self.AT
         c = self.c
         rho = self.rho
-        N, M = self.N, self.M
-        f = self.f
 
-        b = np.array([c[i] - safedot(B[i], z) - safedot(A[i], x) for i in range(M)])
         # iterate x
-        for i in range(10):
-            xk = self.update_x(f, rho, A, AT, u, b)
-            self.x = xk
+        xk = self.update_x(u, self.Ax + z - c)
+        Ax = safedot(A, xk)
+
+        # over-relaxation
+        Ax_hat = self.relax * Ax + (1 - self.relax) * (c - z)
 
         # iterate z
-        zk = self.update_z(rho, B, BT, u, b)
+        zk = self.update_z(u, c - Ax_hat)
 
         # iterate u
-        uk = u - rho * b
+        uk = u + rho * (Ax_hat + zk - c)
+        delta = Ax + zk - c
+
+        # The x step is inexact, (mu - rho A^T A) (xk - x) enters the dual
+        # residual
+        dx = xk - x
+        s = norm(self.mu * dx - rho * safedot(AT, safedot(A, dx)) +
+                 rho * safedot(AT, z - zk))
+        self.x, self.z, self.u, self.Ax = xk, zk, uk, Ax
+        return norm(delta), s
+
+class ConsensusBlock(object):
+    """
+    One block of ConsensusADMM: a group of links and the flows traversing
+    them. The copies of the flows shared with other blocks are exchanged
+    through the shared arrays X, Y (one slot per copy) and Z (the consensus
+    value of each shared flow).
+    """
+
+    def __init__(self, A, c, alpha, w, shared, slots, z_idx, X, Y, Z):
+        self.A = A
+        self.c = c
+        self.alpha = alpha
+        self.w = w
+        self.shared = shared
+        self.slots = slots
+        self.z_idx = z_idx
+        self.arrays = (X, Y, Z)
+
+        self.x = None
+        self.la = None
+        self.y = np.zeros(len(shared))
+
+    def attach(self):
+        # The numpy views of the shared arrays, made in the worker process
+        X, Y, Z = [np.frombuffer(a) for a in self.arrays]
+        self.X, self.Y, self.Z = X, Y, Z
+
+    def step(self, rho, first, niter):
+        """
+        Update the price of the shared copies, then take up to niter
+        interior point iterations on the subproblem from the last solution.
+        """
+        if not hasattr(self, 'Z'):
+            self.attach()
+        if not first:
+            self.y += rho * (self.x[self.shared] - self.Z[self.z_idx])
+        return self.solve(rho, niter)
+
+    def solve(self, rho, niter=100):
+        if not hasattr(self, 'Z'):
+            self.attach()
+        n = self.A.shape[1]
+        z = self.Z[self.z_idx]
+
+        alpha, w = self.alpha, self.w
+        mask = np.zeros(n)
+        mask[self.shared] = rho
+        offset = np.zeros(n)
+        offset[self.shared] = self.y - rho * z
+
+        # The utilities plus the proximal terms y * x + rho/2 * (x - z)^2 of
+        # the shared copies
+        grad = lambda x: -w * np.power(x, -alpha) + mask * x + offset
+        hess = lambda x: w * alpha * np.power(x, -alpha-1) + mask
+        info = {}
+        self.x, self.la = interior_point(self.A, self.c, grad, hess,
+                                         self.x, self.la, niter=niter,
+                                         info=info)
+        self.X[self.slots] = self.x[self.shared]
+        self.Y[self.slots] = self.y
+        return info
+
+    def result(self):
+        return self.x, self.la
+
+def consensus_worker(conn, block):
+    """
+    The main loop of a ConsensusADMM worker.
+    """
+    while True:
+        method, args = conn.recv()
+        if method is None:
+            break
+        try:
+            ret = getattr(block, method)(*args)
+        except Exception as e:
+            ret = e
+        conn.send(ret)
+    conn.close()
+
+class ConsensusADMM(object):
+    """
+    Consensus ADMM for the alpha-fair NUM problem
+
+        max sum(w * U(x))
+           Ax <= c
+
+    with the links partitioned into blocks, e.g. the pods of a Clos topology
+    (see estimator.PodBlocks). Each block owns the constraints of its links
+    and a local copy of the flows traversing them, and the utility of a
+    shared flow is split evenly among its copies. In each round, the blocks
+    take `inner` interior point iterations on their proximal subproblems,
+    warm-started from the last round, in parallel worker processes, i.e. an
+    inexact ADMM. The subproblems are solved to convergence once the
+    consensus is reached. Only the copies of the flows shared by several
+    blocks cross the block boundary, through shared memory.
+
+    This is experimental: it takes a few hundred rounds, and even with a
+    single interior point iteration per round it is one or two orders of
+    magnitude slower than numsolver.solve_num_ipm on the whole problem, so
+    more cores cannot make up for it. It is not used unless requested.
+
+    blocks: the block of each row of A
+    rho: the penalty of the consensus constraints (default: the median
+         curvature of the utilities of the shared flows at the start)
+    eps_abs, eps_rel: the tolerances on the primal and dual residuals
+    parallel: run each block in its own worker process
+    inner: the number of interior point iterations of a block per round
+    """
 
-        e = max(((self.x - xk)/xk)**2)
-        self.x, self.z, self.u = xk, zk, uk
-        return e
+    def __init__(self, A, c, alpha, w, blocks, rho=None, eps_abs=1e-6,
+                 eps_rel=1e-4, parallel=True, inner=1):
+        A = sp.csr_matrix(A, dtype=float)
+        c = np.asarray(c, dtype=float).flatten()
+        alpha = np.asarray(alpha, dtype=float)
+        w = np.asarray(w, dtype=float)
+        blocks = np.asarray(blocks, dtype=int)
+        M, N = A.shape
+        assert M == len(c) and M == len(blocks)
+        B = blocks.max() + 1 if M else 1
+        self.M, self.N, self.B = M, N, B
+
+        # The blocks traversed by each flow
+        row_of = np.repeat(np.arange(M), np.diff(A.indptr))
+        member = sp.csc_matrix((np.ones(A.nnz), (blocks[row_of], A.indices)),
+                               shape=(B, N))
+        member.sum_duplicates()
+        copies = np.diff(member.indptr)
+        self.shared_flows = np.flatnonzero(copies > 1)
+        z_of = np.full(N, -1)
+        z_of[self.shared_flows] = np.arange(len(self.shared_flows))
+
+        self.rows = []
+        self.flows = []
+        block_shared = []
+        for b in range(B):
+            rows = np.flatnonzero(blocks == b)
+            flows = np.unique(A[rows].indices)
+            self.rows.append(rows)
+            self.flows.append(flows)
+            block_shared.append(np.flatnonzero(copies[flows] > 1))
+        slot_ptr = np.cumsum([0] + [len(s) for s in block_shared])
+        self.slot_z = np.concatenate(
+            [z_of[f[s]] for f, s in zip(self.flows, block_shared)] +
+            [np.zeros(0, dtype=int)])
+        S = len(self.slot_z)
+        # Sums the copies of each shared flow
+        self.avg = sp.csr_matrix((np.ones(S), (self.slot_z, np.arange(S))),
+                                 shape=(len(self.shared_flows), S))
+        self.copies = copies[self.shared_flows]
+
+        self.X = multiprocessing.RawArray('d', max(S, 1))
+        self.Y = multiprocessing.RawArray('d', max(S, 1))
+        self.Z = multiprocessing.RawArray('d', max(len(self.shared_flows), 1))
+        self._X, self._Y, self._Z = [np.frombuffer(a)
+                                     for a in (self.X, self.Y, self.Z)]
+
+        # Start the consensus from half the fair share on the tightest link
+        AT = A.T.tocsr()
+        x0 = 0.5 * path_min(AT, c / np.maximum(A.dot(np.ones(N)), 1), 2)
+        z0 = x0[self.shared_flows]
+        self._Z[:len(z0)] = z0
+        if rho is None:
+            a = alpha[self.shared_flows]
+            curv = w[self.shared_flows] / self.copies * a * \
+                np.power(z0, -a - 1)
+            rho = np.median(curv) if len(curv) else 1
+        self.rho = rho
+        self.eps_abs = eps_abs
+        self.eps_rel = eps_rel
+        self.inner = inner
+
+        self.blocks = []
+        for b in range(B):
+            flows = self.flows[b]
+            self.blocks.append(ConsensusBlock(
+                A[self.rows[b]][:, flows], c[self.rows[b]], alpha[flows],
+                w[flows] / np.maximum(copies[flows], 1), block_shared[b],
+                np.arange(slot_ptr[b], slot_ptr[b+1]),
+                z_of[flows[block_shared[b]]], self.X, self.Y, self.Z))
+
+        self.conns = []
+        self.procs = []
+        if parallel and B > 1:
+            for block in self.blocks:
+                conn, child_conn = multiprocessing.Pipe()
+                proc = multiprocessing.Process(target=consensus_worker,
+                                               args=(child_conn, block))
+                proc.daemon = True
+                proc.start()
+                child_conn.close()
+                self.conns.append(conn)
+                self.procs.append(proc)
+
+    def call(self, method, *args):
+        if not self.conns:
+            return [getattr(block, method)(*args) for block in self.blocks]
+        for conn in self.conns:
+            conn.send((method, args))
+        ret = [conn.recv() for conn in self.conns]
+        for r in ret:
+            if isinstance(r, Exception):
+                raise r
+        return ret
+
+    def solve(self, niter=1000, debug=False, info=None):
+        """
+        Return (x, la) of the NUM problem.
+        """
+        S = len(self.slot_z)
+        X, Y, Z = self._X[:S], self._Y[:S], self._Z[:len(self.copies)]
+        status = 'unknown'
+        it = 0
+        for it in range(1, niter + 1):
+            if not S:
+                # A single block, or blocks without shared flows
+                self.call('solve', self.rho)
+                status = 'optimal'
+                break
+            self.call('step', self.rho, it == 1, self.inner)
+
+            z_prev = Z.copy()
+            Z[:] = self.avg.dot(X) / self.copies
+            r = norm(X - Z[self.slot_z])
+            s = self.rho * norm((Z - z_prev)[self.slot_z])
+            eps_pri = np.sqrt(S) * self.eps_abs + \
+                self.eps_rel * max(norm(X), norm(Z[self.slot_z]))
+            eps_dual = np.sqrt(S) * self.eps_abs + self.eps_rel * norm(Y)
+            if debug:
+                print('%4d: r = %.3e (%.3e), s = %.3e (%.3e)'
+                      % (it, r, eps_pri, s, eps_dual))
+            if r <= eps_pri and s <= eps_dual:
+                status = 'optimal'
+                break
+        if S:
+            # Solve the subproblems at the final consensus to convergence
+            self.call('solve', self.rho)
+
+        x = np.zeros(self.N)
+        la = np.zeros(self.M)
+        for b, (xb, lab) in enumerate(self.call('result')):
+            x[self.flows[b]] = xb
+            la[self.rows[b]] = lab
+        x[self.shared_flows] = Z
+        if info is not None:
+            info['status'] = status
+            info['iterations'] = it
+        return x, la
+
+    def close(self):
+        for conn in self.conns:
+            conn.send((None, None))
+            conn.close()
+        for proc in self.procs:
+            proc.join()
+        self.conns, self.procs = [], []
 
 def argmin_f(f, rho, A, AT, u, c):
     M, N = A.shape
 
-    sq = lambda _x: np.array([safedot(A[i], _x) - c[i] for i in range(M)])
+    sq = lambda _x: safedot(A, _x) - c
     pr = lambda _sqx: np.dot(u, _sqx) + rho / 2 * sum(_sqx**2)
     fs = lambda _x: sum(f(_x))
     obj = lambda _x: -fs(_x) + pr(sq(_x))
 
-    uTA = [np.dot(AT[i], u) for i in range(N)]
-    pprime = lambda _x: np.array(uTA)
-    ppprime = lambda _sqx: np.array([np.dot(AT[j], _sqx) for j in range(N)])
+    uTA = safedot(AT, u)
+    pprime = lambda _x: uTA
+    ppprime = lambda _sqx: safedot(AT, _sqx)
     fprime = lambda _x: -1/np.maximum(_x, 1e-4) + 1e2 * np.sign(np.minimum(_x - 1e-4, 0))
     jac = lambda _x: fprime(_x) + pprime(_x) + rho * ppprime(sq(_x))
 
     x = np.ones(N)
 
-    b = np.asarray(A)[0]
     xs = fmin_ncg(obj, x, fprime=jac,
                   disp=0)
                     #bounds=[(0, np.inf) for i in range(N)], disp=0)
@@ -198,44 +675,30 @@ def argmin_f(f, rho, A, AT, u, c):
 def argmin_f2(f, rho, A, AT, u, c):
     M, N = A.shape
 
-    sq = lambda _x: np.array([safedot(A[i], _x) - c[i] for i in range(M)])
+    sq = lambda _x: safedot(A, _x) - c
     pr = lambda _sqx: np.dot(u, _sqx) + rho / 2 * sum(_sqx**2)
     fs = lambda _x: sum(f(_x))
     obj = lambda _x: -fs(_x) + pr(sq(_x))
 
-    uTA = [np.dot(AT[i], u) for i in range(N)]
-    pprime = lambda _x: np.array(uTA)
-    ppprime = lambda _sqx: np.array([np.dot(AT[j], _sqx) for j in range(N)])
+    uTA = safedot(AT, u)
+    pprime = lambda _x: uTA
+    ppprime = lambda _sqx: safedot(AT, _sqx)
     fprime = lambda _x: -1/_x
     jac = lambda _x: fprime(_x) + pprime(_x) + rho * ppprime(sq(_x))
 
     x = np.ones(N)
 
-    b = np.asarray(A)[0]
     xs = fmin_slsqp(obj, x, fprime=jac,
                     bounds=[(0, np.inf) for i in range(N)], iter=10, disp=0)
     return xs
 
 def argmin_g(rho, B, BT, u, c):
-    M = len(B)
-
-    sq = lambda _x: _x - c
-    pr = lambda _x: np.dot(u, _x) + rho / 2 * sum(_x**2)
-    obj = lambda _x: pr(sq(_x))
-
-    uTB = u
-    pprime = lambda _x: np.array(uTB)
-    ppprime = lambda _sqx: _sqx
-    jac = lambda _x: pprime(_x) + rho * ppprime(sq(_x))
-
-    x = np.zeros(M)
-
-    xs = fmin_slsqp(obj, x, fprime=jac,
-                    bounds=[(1e-4, np.inf) for i in range(M)], iter=10, disp=0)
-    return xs
+    # argmin u * (z - c) + rho/2 * ||z - c||^2 over z >= 1e-4 with B = I,
+    # which is a projection
+    return np.maximum(c - u / rho, 1e-4)
 
 if __name__ == '__main__':
-    import time, datetime
+    import datetime
     start = datetime.datetime.now()
     import sys, random
     H, F = sys.argv[1:]
@@ -275,6 +738,13 @@ if __name__ == '__main__':
 
     print(end - start)
 
+    for mode in [{}, {'relax': 1.6}, {'anderson': 5}, {'adaptive': True},
+                 {'relax': 1.6, 'anderson': 5, 'adaptive': True}]:
+        admm = FullADMM(f2, sp.csr_matrix(A), c, **mode)
+        xa, _, _ = admm.solve(10000)
+        print('%(mode)s: %(iterations)d iterations in %(time).3fs' % admm.stats,
+              'diff:', np.max(np.abs(xa - x)) / np.max(x))
+
     #print(sum(f1(x1)), np.max(A * np.array(x1) - c))
     #print(sum(f1(x2)), np.max(A * x2 - c))
     #print(x, u)
@@ -7,7 +7,7 @@ import numpy as np
 from random import randint
 
 from mininet.log import setLogLevel
-from estimator import Spherical2Cartesian, Estimate
+from estimator import Spherical2Cartesian, Estimate, RoutingMatrix
 from testcase import ClosTopologyTest
 from util.arsaconf import parse_argument
 from util.case import Case
@@ -67,43 +67,6 @@ def UpdateFlows(K, flows, rho, x):
     x.append(1e-2)
     return flows, rho, x
 
-def RoutingMatrix(flows):
-    links = {}
-    F = len(flows)
-    for i in range(F):
-        f = flows[i]
-        slink = tuple(f['from'] + [0])
-        if slink not in links.keys():
-            links[slink] = np.zeros(F)
-        rflows = links[slink]
-        rflows[i] = 1
-        dlink = tuple(f['to'] + [1])
-        if dlink not in links.keys():
-            links[dlink] = np.zeros(F)
-        rflows = links[dlink]
-        rflows[i] = 1
-
-    A = []
-    signal = lambda l, lp: (1 in l-lp) + 2*(-1 in l-lp)
-
-    _links = links.keys()
-    while _links:
-        k = _links.pop()
-        l = links[k]
-        valid = True
-        for kp in _links:
-            lp = links[kp]
-            s = signal(l, lp)
-            if s < 2:
-                _links.remove(kp)
-            elif s == 2:
-                valid = False
-                break
-        if valid:
-            A.append(l)
-
-    return np.mat(A)
-
 if __name__ == '__main__':
     setLogLevel('info')
     cmdline = parse_argument()
@@ -131,7 +94,7 @@ if __name__ == '__main__':
 
     log_file.write('Setup the training environment...\n')
     A = RoutingMatrix(flows)
-    log_file.write('Routing Matrix:\n%s\n' % A)
+    log_file.write('Routing Matrix:\n%s\n' % A.toarray())
     c = [1] * A.shape[0]
     log_file.write('Capacity Vector: %s\n' % c)
     a = [1] * A.shape[1]
@@ -154,7 +117,7 @@ if __name__ == '__main__':
 
     log_file.write('Setup the prediction environment...\n')
     A = RoutingMatrix(flows)
-    log_file.write('Routing Matrix:\n%s\n' % A)
+    log_file.write('Routing Matrix:\n%s\n' % A.toarray())
     c = [1] * A.shape[0]
     log_file.write('Capacity Vector: %s\n' % c)
     a = [1] * A.shape[1]
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+
+import numpy as np
+import scipy.sparse as sp
+
+from estimator import CompileSample
+
+def ReadSamples(basedir, prefix='train', rate_suffix='.nsout', scale=None):
+    """
+    Read the <prefix>*.json flow specifications and the rates in the
+    matching <name><rate_suffix> files of a directory, sorted by name.
+
+    scale: the factor applied to the rates (default: 1e-6 for .mnout,
+           otherwise 1)
+    """
+    if scale is None:
+        scale = 1e-6 if rate_suffix.endswith('.mnout') else 1
+    filelist = os.listdir(basedir)
+    names = [f[:-5] for f in filelist
+             if f.endswith('.json') and f.startswith(prefix)]
+    names.sort()
+
+    samples = []
+    for name in names:
+        rate_file = name + rate_suffix
+        if rate_file not in filelist:
+            continue
+        flows = json.load(open(os.path.join(basedir, name + '.json')))
+        rates = np.array(open(os.path.join(basedir, rate_file)).read().split(),
+                         dtype=float) * scale
+        samples.append((name, flows, rates))
+    return samples
+
+def CompileDataset(samples, K, path):
+    """
+    Compile the (name, flows, rates) samples into a directory of .npy files,
+    one per array, so that Dataset can memory-map them.
+
+    The per-sample arrays are concatenated, with flow_ptr, link_ptr and
+    nnz_ptr giving the flow, link and nonzero ranges of each sample. The
+    routing matrices are stored in CSR form, with the local indptr of each
+    sample (L + 1 entries) stored back to back in a_indptr.
+    """
+    names, rates, alphas, rho_idxs, capacities = [], [], [], [], []
+    a_data, a_indices, a_indptr = [], [], []
+    flow_ptr, link_ptr, nnz_ptr = [0], [0], [0]
+    for name, flows, x in samples:
+        A, c, alpha, x, rho_idx = CompileSample(flows, x, K)
+        A = sp.csr_matrix(A, dtype=float)
+        L, F = A.shape
+
+        names.append(name)
+        rates.append(np.asarray(x, dtype=float))
+        alphas.append(np.asarray(alpha, dtype=float))
+        rho_idxs.append(np.asarray(rho_idx, dtype=int))
+        capacities.append(np.asarray(c, dtype=float))
+        a_data.append(A.data)
+        a_indices.append(A.indices)
+        a_indptr.append(A.indptr)
+        flow_ptr.append(flow_ptr[-1] + F)
+        link_ptr.append(link_ptr[-1] + L)
+        nnz_ptr.append(nnz_ptr[-1] + A.nnz)
+
+    cat = lambda l, dtype: np.concatenate(l) if l else np.zeros(0, dtype=dtype)
+    arrays = {'K': np.array(K),
+              'names': np.array(names, dtype=str),
+              'flow_ptr': np.array(flow_ptr, dtype=int),
+              'link_ptr': np.array(link_ptr, dtype=int),
+              'nnz_ptr': np.array(nnz_ptr, dtype=int),
+              'rates': cat(rates, float),
+              'alpha': cat(alphas, float),
+              'rho_idx': cat(rho_idxs, int),
+              'capacity': cat(capacities, float),
+              'a_data': cat(a_data, float),
+              'a_indices': cat(a_indices, int),
+              'a_indptr': cat(a_indptr, int)}
+    os.makedirs(path, exist_ok=True)
+    for key, array in arrays.items():
+        np.save(os.path.join(path, key + '.npy'), array)
+
+class Dataset(object):
+    """
+    A compiled training set, see CompileDataset.
+
+    The concatenated arrays are memory-mapped read-only the first time they
+    are needed, and a sample is a tuple of views into them, in the
+    (A, c, alpha, x, rho_idx) format of estimator.TrainNg, so only the pages
+    of the samples in use are read. The small offset arrays are loaded.
+
+    close() drops the maps of the dataset, the views already handed out keep
+    theirs until they are released. A Dataset is also a context manager.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.K = int(np.load(os.path.join(path, 'K.npy')))
+        self.flow_ptr = np.load(os.path.join(path, 'flow_ptr.npy'))
+        self.link_ptr = np.load(os.path.join(path, 'link_ptr.npy'))
+        self.nnz_ptr = np.load(os.path.join(path, 'nnz_ptr.npy'))
+        self.arrays = {}
+
+    def array(self, key):
+        if key not in self.arrays:
+            self.arrays[key] = np.load(os.path.join(self.path, key + '.npy'),
+                                       mmap_mode='r')
+        return self.arrays[key]
+
+    def close(self):
+        self.arrays = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def names(self):
+        return self.array('names')
+
+    def __len__(self):
+        return len(self.flow_ptr) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('sample index out of range')
+
+        f0, f1 = self.flow_ptr[i], self.flow_ptr[i+1]
+        l0, l1 = self.link_ptr[i], self.link_ptr[i+1]
+        n0, n1 = self.nnz_ptr[i], self.nnz_ptr[i+1]
+        # a_indptr holds the L + 1 local offsets of each sample
+        A = sp.csr_matrix((self.array('a_data')[n0:n1],
+                           self.array('a_indices')[n0:n1],
+                           self.array('a_indptr')[l0+i:l1+i+1]),
+                          shape=(l1 - l0, f1 - f0), copy=False)
+        return (A,
+                self.array('capacity')[l0:l1],
+                self.array('alpha')[f0:f1],
+                self.array('rates')[f0:f1],
+                self.array('rho_idx')[f0:f1])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('%s <sample_dir> <dataset_dir> [K] [rate_suffix]' % sys.argv[0])
+        sys.exit(0)
+
+    K = 4
+    if len(sys.argv) > 3:
+        K = int(sys.argv[3])
+    rate_suffix = '.nsout'
+    if len(sys.argv) > 4:
+        rate_suffix = sys.argv[4]
+
+    samples = ReadSamples(sys.argv[1], rate_suffix=rate_suffix)
+    CompileDataset(samples, K, sys.argv[2])
+    print('Compiled %d samples into %s' % (len(samples), sys.argv[2]))
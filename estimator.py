@@ -1,12 +1,67 @@
 #!/usr/bin/env python3
 
+import multiprocessing
+from collections import OrderedDict, namedtuple
+
 import numpy as np
+import scipy.sparse as sp
 from scipy.optimize import fmin_slsqp, least_squares
+from scipy.sparse.csgraph import connected_components, reverse_cuthill_mckee
+from scipy.sparse.linalg import splu
 
 from util.const import TCP_ALPHA
 from util.cmd import RED
 
 import numsolver
+import admm
+
+def UtilityArrays(alpha, rho, rho_idx=None):
+    """
+    Precompute the arrays used by UtilityKernel and JacKernel.
+
+    alpha: vector of base utility factors
+    rho: vector of scaling factors
+    rho_idx: index of scaling factor each flow has
+
+    Return (alpha, rho_j, log_mask), where rho_j = rho[rho_idx] and
+    log_mask = (alpha == 1).
+    """
+    alpha = np.asarray(alpha, dtype=float)
+    rho = np.asarray(rho, dtype=float)
+    if rho_idx is None:
+        rho_idx = np.arange(len(alpha))
+    rho_j = rho[np.asarray(rho_idx, dtype=int)]
+    return alpha, rho_j, alpha == 1
+
+def UtilityKernel(alpha, rho_j, log_mask, x):
+    """
+    Vectorized Utility on the arrays returned by UtilityArrays.
+
+    No validation is done here, it is meant for the inner loop of the
+    optimizers.
+    """
+    x = np.asarray(x, dtype=float)
+    beta = np.where(log_mask, 1, 1 - alpha)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        u = np.where(log_mask,
+                     np.where(x > 1e-323, np.log(x), -1e4),
+                     np.power(x, beta) / beta)
+    return np.dot(rho_j, u)
+
+def JacKernel(alpha, rho_j, log_mask, x):
+    """
+    Vectorized Jac on the arrays returned by UtilityArrays.
+    """
+    x = np.asarray(x, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        return rho_j * np.where(x > 1e-308, np.power(x, -alpha), 1e308)
+
+def CheckUtilityArgs(A, c, alpha, rho, rho_idx):
+    J = len(alpha)
+    K = len(c)
+    assert A.shape == (K, J)
+    assert len(rho_idx) == J
+    assert set(range(len(rho))).issuperset(rho_idx)
 
 def Utility(A, c, alpha, rho, _x, rho_idx=None):
     """
@@ -20,151 +75,141 @@ def Utility(A, c, alpha, rho, _x, rho_idx=None):
         slack: slack variable
     rho_idx: index of scaling factor each flow has
     """
-    A = np.array(A)
-    J = len(alpha)
-    K = len(c)
-    rho_idx = rho_idx or range(J)
-    assert A.shape == (K, J)
-    assert len(rho_idx) == J
-    assert set(range(len(rho))).issuperset(rho_idx)
-    # assert len(_x) == J + 2 * K
-
-    # x = _x[:J]
-    x = _x
-    # la = _x[J:J+K]
-    # s = _x[J+K:]
+    rho_idx = rho_idx or range(len(alpha))
+    CheckUtilityArgs(A, c, alpha, rho, rho_idx)
 
     # _x = x//lamb//s
     # L(_x) = f(x) - lamb.T * (g(x) - s^2)
     # f(x) = sum(-U(x_i))
     # g(x) = c - A x
-    L = 0
-    for j in range(J):
-        if alpha[j] == 1:
-            # L += rho[rho_idx[j]] * np.log(x[j])
-            L += rho[rho_idx[j]] * (np.log(x[j]) if x[j] > 1e-323 else -1e4)
-        else:
-            L += rho[rho_idx[j]] * np.power(x[j], 1-alpha[j]) / (1-alpha[j])
-
-    # for k in range(K):
-    #     L -= la[k] * (c[k] - np.dot(A[k], x) - s[k]**2)
-
-    return L
+    return UtilityKernel(*UtilityArrays(alpha, rho, rho_idx), _x)
 
 def Jac(A, c, alpha, rho, _x, rho_idx=None):
-    A = np.array(A)
-    J = len(alpha)
-    K = len(c)
-    rho_idx = rho_idx or range(J)
-    assert A.shape == (K, J)
-    assert len(rho_idx) == J
-    assert set(range(len(rho))).issuperset(rho_idx)
-    # assert len(_x) == J + 2 * K
-
-    # x = _x[:J]
-    x = _x
-    # la = _x[J:J+K]
-    # s = _x[J+K:]
+    rho_idx = rho_idx or range(len(alpha))
+    CheckUtilityArgs(A, c, alpha, rho, rho_idx)
 
     # nabla_x L = nabla_x f - lamb.T * A
-    # nalba_lamb = s^2 - g(x)
-    # nalba_s = 2 * lamb * s
-    return np.array([
-        # rho[rho_idx[j]] * (np.power(x[j], -alpha[j]) if x[j] > 1e-308 else 1e308) - np.dot(la, np.array(A)[:,j]) for j in range(J)
-        rho[rho_idx[j]] * (np.power(x[j], -alpha[j]) if x[j] > 1e-308 else 1e308) for j in range(J)
-    # ] + [
-    #     s[k]**2 - c[k] + np.dot(A[k], x) for k in range(K)
-    # ] + [
-    #     2 * la[k] for k in range(K)
-    ])
+    return JacKernel(*UtilityArrays(alpha, rho, rho_idx), _x)
+
+def AsMatrix(A):
+    """
+    Return A as a 2-d array, or as a CSR matrix if A is sparse.
+    """
+    return sp.csr_matrix(A) if sp.issparse(A) else np.asarray(A)
+
+def DenseMatrix(A):
+    return A.toarray() if sp.issparse(A) else np.asarray(A)
 
 def PenaltyFunc(A, c, x):
-    A = np.array(A)
-    return [np.dot(A[k], x) - c[k] for k in range(len(c))]
+    return AsMatrix(A).dot(x) - c
 
 def ConsFunc(A, c, x, s):
-    A = np.array(A)
+    A = AsMatrix(A)
     J = len(x)
     K = len(c)
     assert A.shape == (K, J)
     assert len(s) == K
 
     # c - A x - s^2 = 0
-    return np.array([
-        c[k] - np.dot(A[k], x) - s[k]**2 for k in range(K)
-    ])
+    return c - A.dot(x) - np.power(s, 2)
 
 def ConsJac(A, c, x, s):
-    A = np.array(A)
+    A = DenseMatrix(A)
     J = len(x)
     K = len(c)
     assert A.shape == (K, J)
     assert len(s) == K
 
-    return np.array([
-        (-A[k]).tolist() +
-        [0 for la in range(K)] +
-        [-2*s[i] if i == k else 0 for i in range(K)]
-        for k in range(K)
-    ])
+    return np.hstack([-A, np.zeros((K, K)), np.diag(-2 * np.asarray(s))])
 
 def IConsFunc(A, c, x):
-    A = np.array(A)
+    A = AsMatrix(A)
     J = len(x)
     K = len(c)
     assert A.shape == (K, J)
 
-    # c - A x - s^2 = 0
-    return np.array([
-        c[k] - np.dot(A[k], x) for k in range(K)
-    ])
+    # c - A x >= 0
+    return c - A.dot(x)
 
 def IConsJac(A, c, x):
-    A = np.array(A)
+    A = DenseMatrix(A)
     J = len(x)
     K = len(c)
     assert A.shape == (K, J)
 
-    return np.array([
-        (-A[k]).tolist() for k in range(K)
-    ])
+    return -A
 
 def Spherical2Cartesian(theta):
-    N = len(theta)
-    car = np.zeros(N+1)
-    sin_t = np.sin(theta)
-    cos_t = np.cos(theta)
+    """
+    Map the N angles theta to the N+1 coordinates of a point on the unit
+    sphere:
 
-    car[0] = 1
-    for i in range(1, N+1):
-        car[i] = car[i-1]*sin_t[i-1]
+        car[i] = cos(theta[i]) * prod(sin(theta[:i])), i < N
+        car[N] = prod(sin(theta))
 
-    for i in range(N):
-        car[i] *= cos_t[i]
+    theta can also be a (B, N) array of B angle vectors, a (B, N+1) array is
+    returned then.
+    """
+    theta = np.asarray(theta, dtype=float)
+    ones = np.ones(theta.shape[:-1] + (1,))
+    sin_prod = np.concatenate((ones, np.cumprod(np.sin(theta), axis=-1)),
+                              axis=-1)
+    return sin_prod * np.concatenate((np.cos(theta), ones), axis=-1)
 
-    return car
+def Cartesian2Spherical(car):
+    """
+    The inverse of Spherical2Cartesian for a point with non-negative
+    coordinates, of any norm:
+
+        theta[i] = arctan2(|car[i+1:]|, car[i])
+    """
+    car = np.asarray(car, dtype=float)
+    tail = np.sqrt(np.cumsum(car[::-1]**2)[::-1])
+    return np.arctan2(tail[1:], car[:-1])
 
 def SphericalJac(theta):
+    """
+    The (N+1)xN jacobian of Spherical2Cartesian.
+    """
+    theta = np.asarray(theta, dtype=float)
     N = len(theta)
-    jac = np.zeros((N+1, N))
     sin_t = np.sin(theta)
     cos_t = np.cos(theta)
+    sin_prod = np.concatenate(([1], np.cumprod(sin_t)))
+    car = Spherical2Cartesian(theta)
+
+    # d car[i] / d theta[j] = car[i] * cos(theta[j]) / sin(theta[j]), j < i
+    with np.errstate(divide='ignore', invalid='ignore'):
+        jac = np.tril(np.outer(car, cos_t / sin_t), -1)
+    for j in np.flatnonzero(sin_t == 0):
+        prod = sin_prod[j] * cos_t[j] * np.concatenate(([1], np.cumprod(sin_t[j+1:])))
+        jac[j+1:, j] = prod * np.concatenate((cos_t[j+1:], [1]))
+    jac[np.arange(N), np.arange(N)] = -sin_prod[:N] * sin_t
+    return jac
 
-    for i in range(N+1):
-        for j in range(N):
-            if j < i:
-                jac[i, j] = np.prod([cos_t[t] if t==j else sin_t[t]
-                                     for t in range(i-1)]) * cos_t[j]
-            elif j == i:
-                jac[i, j] = -np.prod(sin_t[:i])
-            else:
-                jac[i, j] = 0
+def SphericalJacDot(theta, dp):
+    """
+    Compute dp * SphericalJac(theta) for a dense (M, N+1) matrix dp, without
+    building the jacobian.
+    """
+    theta = np.asarray(theta, dtype=float)
+    dp = np.asarray(dp)
+    sin_t = np.sin(theta)
+    if np.any(sin_t == 0):
+        return dp.dot(SphericalJac(theta))
 
-    return jac
+    N = len(theta)
+    cos_t = np.cos(theta)
+    sin_prod = np.concatenate(([1], np.cumprod(sin_t)))
+    car = Spherical2Cartesian(theta)
+
+    # tail[:, j] = sum(dp[:, i] * car[i] for i > j)
+    tail = np.cumsum((dp * car)[:, ::-1], axis=1)[:, ::-1][:, 1:]
+    return tail * (cos_t / sin_t) - dp[:, :N] * (sin_prod[:N] * sin_t)
 
 def ApproximateLa(A, c, x, grad, g):
     K = len(c)
-    A_la = np.bmat([[A.T], [np.diag(g(x) > 1e-8)]])
+    A_la = np.bmat([[DenseMatrix(A).T], [np.diag(g(x) > 1e-8)]])
     C_la = np.bmat([[np.mat(grad(x)).T], [np.zeros((K, 1))]])
     la, _, _, _ = np.linalg.lstsq(A_la, C_la, rcond=None)
     return np.array(la).flatten()
@@ -186,8 +231,11 @@ def EstimateX_Orig(A, c, alpha, p0, x, p0_idx=None, spherical=True, disp=0):
     # L(_x) = f(x) - lamb.T * (g(x) - s^2)
     # f(x) = sum(-U(x_i))
     # g(x) = c - A x
-    func_util = lambda _x: -Utility(A, c, alpha, p0, _x, p0_idx)
-    func_jac = lambda _x: -Jac(A, c, alpha, p0, _x, p0_idx)
+    p0_idx = p0_idx or range(J)
+    CheckUtilityArgs(A, c, alpha, p0, p0_idx)
+    kernel = UtilityArrays(alpha, p0, p0_idx)
+    func_util = lambda _x: -UtilityKernel(*kernel, _x)
+    func_jac = lambda _x: -JacKernel(*kernel, _x)
     # cons_func = lambda _x: ConsFunc(A, c, _x[:J], _x[J+K:])
     # cons_jac = lambda _x: ConsJac(A, c, _x[:J], _x[J+K:])
     icons_func = lambda _x: IConsFunc(A, c, _x)
@@ -200,119 +248,993 @@ def EstimateX_Orig(A, c, alpha, p0, x, p0_idx=None, spherical=True, disp=0):
     # return _x_esti[:J], _x_esti[J:J+K]
     return _x_esti, ApproximateLa(A, c, _x_esti, func_jac, icons_func)
 
-def EstimateX(A, c, alpha, p0, x, p0_idx=None, spherical=True, disp=0):
+class WarmStart(object):
+    """
+    Keep the last primal/dual pair of a NUM problem, so that the next solve
+    of the same problem with slightly different scaling factors can start
+    from it. It also counts the iterations of warm and cold solves.
+    """
+
+    def __init__(self):
+        self.x = None
+        self.la = None
+
+        self.warm = 0
+        self.cold = 0
+        self.fallback = 0
+        self.warm_iters = 0
+        self.cold_iters = 0
+
+    def start(self, J):
+        """
+        Return the starting point (x, la) for a problem of J flows, or
+        (None, None) if the last equilibrium cannot be used.
+        """
+        if self.x is None or len(self.x) != J or min(self.x) <= 0:
+            return None, None
+        return self.x, self.la
+
+    def update(self, x, la, info, warm):
+        if warm:
+            self.warm += 1
+            self.warm_iters += info.get('iterations', 0)
+        else:
+            self.cold += 1
+            self.cold_iters += info.get('iterations', 0)
+        if info.get('status') == 'optimal' and min(x) > 0:
+            self.x, self.la = x, la
+
+    def merge(self, others):
+        for other in others:
+            self.warm += other.warm
+            self.cold += other.cold
+            self.fallback += other.fallback
+            self.warm_iters += other.warm_iters
+            self.cold_iters += other.cold_iters
+        return self
+
+    def report(self):
+        warm_avg = self.warm_iters / max(self.warm, 1)
+        cold_avg = self.cold_iters / max(self.cold, 1)
+        return ('NUM solves: %d warm (%.1f iters), %d cold (%.1f iters), '
+                '%d fallbacks, %.1f iters saved per warm solve'
+                % (self.warm, warm_avg, self.cold, cold_avg, self.fallback,
+                   cold_avg - warm_avg if self.warm and self.cold else 0))
+
+# The NUM solvers, all called as solver(A, c, alpha, rho, x0, la0, disp,
+# info). They return (x, la) and set info['status'] ('optimal' when they
+# converged) and info['iterations']. x0 and la0 are an optional starting
+# point, ignored by the solvers which cannot use it.
+
+def SolveCvxopt(A, c, alpha, rho, x0=None, la0=None, disp=0, info=None):
+    return numsolver.solve(A, c, alpha, rho, niter=100, debug=disp, x0=x0,
+                           info=info)
+
+def SolveIPM(A, c, alpha, rho, x0=None, la0=None, disp=0, info=None):
+    return numsolver.solve_num_ipm(A, c, alpha, rho, niter=100, debug=disp,
+                                   x0=x0, la0=la0, info=info)
+
+def SolveDual(A, c, alpha, rho, x0=None, la0=None, disp=0, info=None):
+    return numsolver.solve_num_dual(A, c, alpha, rho, debug=disp, la0=la0,
+                                    info=info)
+
+def SolveLink(A, c, alpha, rho, x0=None, la0=None, disp=0, info=None):
+    return numsolver.solve_num_link(A, c, alpha, rho, debug=disp, info=info)
+
+def SolveChain(A, c, alpha, rho, x0=None, la0=None, disp=0, info=None):
+    return numsolver.solve_num_chain(A, c, alpha, rho, debug=disp, la0=la0,
+                                     info=info)
+
+# The largest relative KKT residual of a solution SolveSLSQP reports optimal
+SLSQP_KKT_TOL = 1e-3
+
+def SolveSLSQP(A, c, alpha, rho, x0=None, la0=None, disp=0, info=None):
+    J = len(alpha)
+    if x0 is None:
+        x0 = np.ones(J) / J
+    kernel = UtilityArrays(alpha, rho)
+    func_util = lambda _x: -UtilityKernel(*kernel, _x)
+    func_jac = lambda _x: -JacKernel(*kernel, _x)
+    icons_func = lambda _x: IConsFunc(A, c, _x)
+    icons_jac = lambda _x: IConsJac(A, c, _x)
+    x, _, it, imode, _ = fmin_slsqp(func_util, x0, fprime=func_jac,
+                                    bounds=[(0, np.inf)] * J,
+                                    f_ieqcons=icons_func,
+                                    fprime_ieqcons=icons_jac,
+                                    full_output=True, disp=disp)
+    # ApproximateLa solves A^T la = -U'(x), the link prices are -la
+    la = -ApproximateLa(A, c, x, func_jac, icons_func)
+    if info is not None:
+        # fmin_slsqp may stop early with imode 0 far from the optimum, so
+        # check the KKT conditions as well: the prices la are non-negative,
+        # A^T la = U'(x) and only the tight links carry a price
+        grad = -np.asarray(func_jac(x)).ravel()
+        slack = np.asarray(icons_func(x)).ravel()
+        kkt = max(np.max(np.abs(DenseMatrix(A).T.dot(la) - grad)),
+                  np.max(np.abs(la * slack)), -np.min(la))
+        kkt /= np.max(np.abs(grad))
+        optimal = imode == 0 and min(x) > 0 and kkt <= SLSQP_KKT_TOL
+        info['status'] = 'optimal' if optimal else 'unknown'
+        info['iterations'] = it
+    return x, la
+
+def SolveADMM(A, c, alpha, rho, x0=None, la0=None, disp=0, info=None):
+    kernel = UtilityArrays(alpha, rho)
+    solver = admm.FullADMM(lambda _x: UtilityKernel(*kernel, _x), A, c,
+                           alpha=alpha, w=rho, relax=1.6, anderson=5)
+    x, z, u = solver.solve(10000, step=1000, debug=disp)
+    if info is not None:
+        info['status'] = 'optimal' if solver.stats['converged'] else 'unknown'
+        info['iterations'] = solver.stats['iterations']
+    return x, np.maximum(u, 0)
+
+def SolveConsensus(A, c, alpha, rho, x0=None, la0=None, disp=0, info=None,
+                   blocks=None):
+    """
+    Experimental and much slower than the other solvers, see
+    admm.ConsensusADMM, so SelectSolver never picks it.
+
+    blocks: the block of each row of A, see admm.ConsensusADMM (default: one
+            block per CPU, see LinkBlocks). The blocks are solved in worker
+            processes when there are several, unless this is already a
+            daemonic worker, e.g. of a SamplePool, which cannot start
+            processes. Such a worker uses a single block by default.
+    """
+    nested = multiprocessing.current_process().daemon
+    if blocks is None:
+        blocks = LinkBlocks(A, 1 if nested else multiprocessing.cpu_count())
+    blocks = np.asarray(blocks, dtype=int)
+    parallel = not nested and len(blocks) and blocks.max() > 0
+    solver = admm.ConsensusADMM(A, c, alpha, rho, blocks, parallel=parallel)
+    try:
+        return solver.solve(debug=disp, info=info)
+    finally:
+        solver.close()
+
+NUM_SOLVERS = OrderedDict([
+    ('cvxopt', SolveCvxopt),
+    ('ipm', SolveIPM),
+    ('dual', SolveDual),
+    ('link', SolveLink),
+    ('chain', SolveChain),
+    ('slsqp', SolveSLSQP),
+    ('admm', SolveADMM),
+    ('consensus', SolveConsensus),
+])
+
+# The chain solver is chosen for chains of at most this many links
+CHAIN_LINKS = 64
+
+def IsChain(A):
+    """
+    Whether the links of each flow are consecutive rows of A, as in a linear
+    topology. A single bottleneck is a chain as well.
+    """
+    A = sp.csc_matrix(A)
+    A.sort_indices()
+    hops = np.diff(A.indptr)
+    used = hops > 0
+    first = A.indices[A.indptr[:-1][used]]
+    last = A.indices[A.indptr[1:][used] - 1]
+    return bool(np.all(last - first == hops[used] - 1))
+
+def SelectSolver(A, solver='auto'):
+    """
+    Return the name of the NUM solver to use for the routing matrix A.
+
+    solver: a name in NUM_SOLVERS, or 'auto' to choose by the structure and
+            the size of the problem: the scalar root finder when every flow
+            crosses one link at most, the dual newton method for short
+            chains, the interior point solver while its KxK factorization
+            stays cheap, the dual solver beyond.
+    """
+    if solver != 'auto':
+        if solver not in NUM_SOLVERS:
+            raise ValueError('Unknown NUM solver: %s' % solver)
+        return solver
+    A = sp.csc_matrix(A)
+    if A.shape[1] and np.max(np.diff(A.indptr)) <= 1:
+        return 'link'
+    if A.shape[0] <= CHAIN_LINKS and IsChain(A):
+        return 'chain'
+    nnz = A.nnz
+    if nnz <= 10000:
+        return 'ipm'
+    return 'dual'
+
+def SolveNUM(A, c, alpha, rho, x0=None, la0=None, disp=0, solver='auto',
+             info=None):
+    """
+    Solve the NUM problem with the solver chosen by SelectSolver. If the
+    solve from (x0, la0) fails, it is retried from a cold start, then with
+    cvxopt as the last resort. info['fallback'] counts the retries. A solver
+    raising a numerical error, e.g. on extreme scaling factors, counts as a
+    failed solve, and an ArithmeticError is raised from the last of them if
+    every step failed this way.
+    """
+    if info is None:
+        info = {}
+    errors = []
+
+    def attempt(solve, x0, la0):
+        info.clear()
+        try:
+            return solve(A, c, alpha, rho, x0, la0, disp, info)
+        except (ValueError, ArithmeticError) as e:
+            info['status'] = 'error'
+            errors.append(e)
+            return None, None
+
+    solve = NUM_SOLVERS[SelectSolver(A, solver)]
+    x, la = attempt(solve, x0, la0)
+    fallback = 0
+    if x0 is not None and info['status'] != 'optimal':
+        fallback += 1
+        x, la = attempt(solve, None, None)
+    if info['status'] != 'optimal' and solve is not SolveCvxopt:
+        fallback += 1
+        x, la = attempt(SolveCvxopt, None, None)
+    if x is None:
+        raise ArithmeticError('Every NUM solver failed: %s' % errors[-1]) \
+            from errors[-1]
+    info['fallback'] = fallback
+    return np.array(x).flatten(), np.array(la).flatten()
+
+def SolveNUMArgs(args):
+    # For multiprocessing, which cannot hand back the info dict
+    info = {}
+    x, la = SolveNUM(*args, info=info)
+    return x, la, info
+
+class Components(object):
+    """
+    The connected components of the bipartite flow-link graph of a routing
+    matrix. The NUM problem splits into one independent problem per
+    component.
+
+    The components with a single flow are solved in closed form: the flow
+    gets the smallest capacity on its path (in units of its coefficient in
+    A), and the multiplier of that link is the marginal utility of the
+    flow. A flow without any link is
+    unbounded and gets inf. The other components are solved together as a
+    single block diagonal problem, since one solver call per small component
+    costs more than it saves, and only the large components are split out
+    to be solved in parallel.
+    """
+
+    # The components solved in worker processes must be at least this large
+    PARALLEL_NNZ = 20000
+
+    def __init__(self, A):
+        A = sp.csr_matrix(A, dtype=float)
+        L, F = A.shape
+        self.A = A
+        self.shape = A.shape
+        graph = sp.bmat([[None, A], [A.T, None]], format='csr')
+        n, labels = connected_components(graph, directed=False)
+        link_labels, flow_labels = labels[:L], labels[L:]
+        flow_count = np.bincount(flow_labels, minlength=n)
+
+        # The single flows, and their links in CSR form
+        singles = np.flatnonzero(flow_count[flow_labels] == 1)
+        hops = np.diff(A.tocsc().indptr)
+        self.unbounded = singles[hops[singles] == 0]
+        self.singles = singles[hops[singles] > 0]
+        self.single_links = A.T.tocsr()[self.singles]
+
+        # The other components, the largest first
+        groups = np.flatnonzero(flow_count > 1)
+        flow_order = np.argsort(flow_labels, kind='stable')
+        flow_ptr = np.concatenate(([0], np.cumsum(flow_count)))
+        link_order = np.argsort(link_labels, kind='stable')
+        link_ptr = np.concatenate(
+            ([0], np.cumsum(np.bincount(link_labels, minlength=n))))
+        self.groups = []
+        for g in groups:
+            flows = flow_order[flow_ptr[g]:flow_ptr[g+1]]
+            links = link_order[link_ptr[g]:link_ptr[g+1]]
+            self.groups.append((links, flows))
+        self.groups.sort(key=lambda lf: -len(lf[1]))
+        self.nnz = [np.sum(hops[lf[1]]) for lf in self.groups]
+
+        # All of them as one problem
+        if self.groups:
+            self.links = np.concatenate([lf[0] for lf in self.groups])
+            self.flows = np.concatenate([lf[1] for lf in self.groups])
+        else:
+            self.links = np.array([], dtype=int)
+            self.flows = np.array([], dtype=int)
+        if len(self.flows) == F:
+            self.links = np.arange(L)
+            self.flows = np.arange(F)
+            self.A_groups = A
+        else:
+            self.A_groups = A[self.links][:, self.flows]
+
+    def __len__(self):
+        return len(self.singles) + len(self.unbounded) + len(self.groups)
+
+    def parts(self, workers=1):
+        """
+        Return the (links, flows) to solve separately: the large components
+        when there are several of them to share among the workers, and the
+        rest as a single problem.
+        """
+        large = [lf for lf, nnz in zip(self.groups, self.nnz)
+                 if nnz >= self.PARALLEL_NNZ]
+        if workers <= 1 or len(large) <= 1:
+            return [(self.links, self.flows)]
+        rest = [lf for lf, nnz in zip(self.groups, self.nnz)
+                if nnz < self.PARALLEL_NNZ]
+        if rest:
+            large.append((np.concatenate([lf[0] for lf in rest]),
+                          np.concatenate([lf[1] for lf in rest])))
+        return large
+
+    def solve(self, c, alpha, rho, x0=None, la0=None, disp=0, solver='auto',
+              info=None, workers=1):
+        """
+        Solve the NUM problem of the components, see SolveNUM, and stitch
+        (x, la) back in the order of the flows and links of A. The large
+        components are solved in parallel when workers > 1.
+
+        info gets the status ('optimal' when all the components are), the
+        largest number of iterations and the total number of fallbacks.
+        """
+        L, F = self.shape
+        c = np.asarray(c, dtype=float).flatten()
+        alpha = np.asarray(alpha, dtype=float)
+        rho = np.asarray(rho, dtype=float)
+        if info is None:
+            info = {}
+
+        if len(self.flows) == F and workers <= 1:
+            return SolveNUM(self.A, c, alpha, rho, x0, la0, disp, solver, info)
+
+        x = np.zeros(F)
+        la = np.zeros(L)
+        x[self.unbounded] = np.inf
+
+        # A single flow takes the tightest link of its path
+        S = self.single_links
+        if len(self.singles):
+            caps = c[S.indices] / S.data
+            xs = np.minimum.reduceat(caps, S.indptr[:-1])
+            tight = np.flatnonzero(caps == np.repeat(xs, np.diff(S.indptr)))
+            row = np.searchsorted(S.indptr, tight, side='right') - 1
+            _, first = np.unique(row, return_index=True)
+            j = self.singles
+            x[j] = xs
+            tight = tight[first]
+            la[S.indices[tight]] = (rho[j] * np.power(xs, -alpha[j])
+                                    / S.data[tight])
+
+        parts = self.parts(workers) if len(self.flows) else []
+        args = []
+        for links, flows in parts:
+            A = self.A_groups if len(parts) == 1 else self.A[links][:, flows]
+            args.append((A, c[links], alpha[flows], rho[flows],
+                         None if x0 is None else x0[flows],
+                         None if la0 is None else la0[links],
+                         disp, solver))
+        if len(args) > 1:
+            with multiprocessing.Pool(min(workers, len(args))) as pool:
+                results = pool.map(SolveNUMArgs, args)
+        else:
+            results = [SolveNUMArgs(a) for a in args]
+
+        status = 'optimal'
+        iterations = 0
+        fallback = 0
+        for (links, flows), (xp, lap, info_p) in zip(parts, results):
+            x[flows] = xp
+            la[links] = lap
+            if info_p.get('status') != 'optimal':
+                status = info_p.get('status', 'unknown')
+            iterations = max(iterations, info_p.get('iterations', 0))
+            fallback += info_p.get('fallback', 0)
+        info['status'] = status
+        info['iterations'] = iterations
+        info['fallback'] = fallback
+        return x, la
+
+class Symmetry(object):
+    """
+    The classes of interchangeable flows of a NUM problem, i.e. the flows
+    with the same column in A, the same alpha and the same scaling factor.
+    They get the same rate at the optimum, so the problem reduces to one
+    flow per class, with the column and the scaling factor of the class
+    multiplied by its size:
+
+        max sum_k m_k rho_k U(y_k)
+            sum_k m_k A_k y_k <= c
+
+    The multipliers of the links are unchanged.
+    """
+
+    def __init__(self, A, alpha, p0_idx=None):
+        A = sp.csc_matrix(A, dtype=float)
+        A.sort_indices()
+        F = A.shape[1]
+        if p0_idx is None:
+            p0_idx = range(F)
+        classes = {}
+        inverse = np.zeros(F, dtype=int)
+        for j in range(F):
+            col = slice(A.indptr[j], A.indptr[j+1])
+            key = (A.indices[col].tobytes(), A.data[col].tobytes(), alpha[j],
+                   p0_idx[j])
+            inverse[j] = classes.setdefault(key, len(classes))
+        self.inverse = inverse
+        self.counts = np.bincount(inverse, minlength=len(classes))
+        self.reps = np.zeros(len(classes), dtype=int)
+        self.reps[inverse[::-1]] = np.arange(F)[::-1]
+        if len(classes) < F:
+            self.A = A[:, self.reps].dot(sp.diags(self.counts.astype(float)))
+        else:
+            self.A = A
+
+    def __len__(self):
+        return len(self.reps)
+
+    def reduce(self, alpha, rho, x0=None):
+        """
+        Return (alpha, rho, x0) of the reduced problem.
+        """
+        if len(self) == len(self.inverse):
+            return alpha, rho, x0
+        return (alpha[self.reps], rho[self.reps] * self.counts,
+                None if x0 is None else x0[self.reps])
+
+    def expand(self, y):
+        if len(self) == len(self.inverse):
+            return y
+        return y[self.inverse]
+
+def EstimateX(A, c, alpha, p0, x, p0_idx=None, spherical=True, disp=0,
+              warm=None, solver='auto', symmetry=None, components=None,
+              workers=1):
+    """
+    warm: a WarmStart of this problem. The solve starts from its last
+          equilibrium when there is a usable one, and falls back to a cold
+          start if the warm-started solve fails. cvxopt is the last resort.
+    solver: the NUM solver, see SelectSolver
+    symmetry: the Symmetry of the flows, computed if not given
+    components: the Components of the reduced problem, computed if not given
+    workers: the number of processes to solve large components with
+    """
     _p0 = p0
     transform = lambda p: Spherical2Cartesian(p) if spherical else p
     p0 = transform(_p0)
 
-    J = len(x)
-    p0_idx = p0_idx or range(J)
+    J = len(alpha)
+    if p0_idx is None:
+        p0_idx = range(J)
 
     p0_full = np.array([p0[i] for i in p0_idx])
     c = np.array(c)
     alpha = np.array(alpha)
-    x_esti, la_esti = numsolver.solve(A, c, alpha, p0_full, niter=100, debug=disp)
-    return np.array(x_esti).flatten(), np.array(la_esti).flatten()
+    if symmetry is None:
+        symmetry = Symmetry(A, alpha, p0_idx)
+    if components is None:
+        components = Components(symmetry.A)
+    x0, la0 = warm.start(J) if warm is not None else (None, None)
+    alpha_r, rho_r, x0_r = symmetry.reduce(alpha, p0_full, x0)
+    info = {}
+    y, la_esti = components.solve(c, alpha_r, rho_r, x0_r, la0, disp, solver,
+                                  info, workers)
+    x_esti = symmetry.expand(y)
+    if warm is not None:
+        warm.fallback += info['fallback']
+        warm.update(x_esti, la_esti, info,
+                    x0 is not None and not info['fallback'])
+    return x_esti, la_esti
 
 def ErrorFunc(A, c, alpha, p0, x, p0_idx=None, spherical=True):
-    x_esti, la_esti = EstimateX(A, c, alpha, p0, x, p0_idx, spherical)
-    # abs_err = x_esti - x
-    # rel_err = abs_err / x
-    # print(RED('absolute err=%s' % (abs_err)))
-    # print(RED('relative err=%s' % (rel_err)))
-    # x_err = np.linalg.norm((x_esti - x)/x)**2
-    x_err = x_esti - x
-    return x_err
+    return SampleEvaluator(A, c, alpha, x, p0_idx, spherical).error(p0)
 
-def ErrorJac(A, c, alpha, p0, x, p0_idx=None, spherical=True):
-    _p0 = p0
-    transform = lambda p: Spherical2Cartesian(p) if spherical else p
-    p0 = transform(_p0)
-    P = len(p0)
+def Sensitivity(A, c, alpha, p0, x_esti, la_esti, p0_idx):
+    """
+    Compute the sensitivity of the equilibrium bandwidth with respect to the
+    scaling factors, i.e. the x block of W in D * W = C, where
 
-    K = len(c)
-    J = len(alpha)
-    p0_idx = p0_idx or range(J)
-    x_esti, la_esti = EstimateX(A, c, alpha, p0, x, p0_idx, spherical=False)
-
-    # FIXME: update error jacobian matrix
-    La = np.diag([p0[p0_idx[j]]*alpha[j]*np.power(x_esti[j], -alpha[j]-1)
-                  for j in range(J)])
-    D = np.bmat([[La, A.T],
-                 [np.diag(la_esti)*A, np.diag(PenaltyFunc(A, c, x_esti))]])
-    CX = np.zeros((J, P))
-    for j, i in np.ndindex(CX.shape):
-        if p0_idx[j] == i:
-            CX[j, i] = np.power(x_esti[j], -alpha[j])
-
-    C = np.bmat([[CX],
-                 [np.zeros((K, P))]])
-    if np.linalg.det(D) == 0:
+        D = [[La,           A.T         ],
+             [diag(la) * A, diag(Ax - c)]]
+
+    D is built as a sparse matrix and factorized once. Only the columns of C
+    referenced by p0_idx are solved, the others are left to 0.
+    """
+    A = sp.csr_matrix(A, dtype=float)
+    K, J = A.shape
+    P = len(p0)
+    alpha = np.asarray(alpha, dtype=float)
+    p0_idx = np.asarray(p0_idx, dtype=int)
+    x_esti = np.asarray(x_esti, dtype=float)
+    la_esti = np.asarray(la_esti, dtype=float)
+
+    La = sp.diags(np.asarray(p0)[p0_idx] * alpha * np.power(x_esti, -alpha-1))
+    D = sp.bmat([[La, A.T],
+                 [sp.diags(la_esti).dot(A), sp.diags(A.dot(x_esti) - c)]],
+                format='csc')
+
+    cols, col_idx = np.unique(p0_idx, return_inverse=True)
+    C = np.zeros((J + K, len(cols)))
+    C[np.arange(J), col_idx] = np.power(x_esti, -alpha)
+    try:
+        DW = splu(D).solve(C)
+        if not np.all(np.isfinite(DW)):
+            raise RuntimeError('ill-conditioned matrix D')
+    except RuntimeError:
         # print(RED('Warn(-1): matrix D is not invertible. It is possible that matrix A has a full 0 row or column.'))
-        DW, _, _, _ = np.linalg.lstsq(D, C, rcond=None)
-    else:
-        DW = D.I * C
-    DWX = DW[:J]
+        DW, _, _, _ = np.linalg.lstsq(D.toarray(), C, rcond=None)
 
-    # Update p0
-    # dp = (x_esti/x - 1) / x * DWX
-    dp = DWX
-    if spherical:
-        dp = dp * SphericalJac(_p0)
-    # return 2 * np.array(dp)[0]
-    return np.array(dp)
+    DWX = np.zeros((J, P))
+    DWX[:, cols] = DW[:J]
+    return DWX
+
+def ErrorJac(A, c, alpha, p0, x, p0_idx=None, spherical=True):
+    return SampleEvaluator(A, c, alpha, x, p0_idx, spherical).jac(p0)
+
+class SampleEvaluator(object):
+    """
+    Evaluate ErrorFunc and ErrorJac of one sample.
+
+    The NUM solution (x_esti, la_esti) and the jacobian are memoized in a
+    bounded LRU cache keyed on the footprint of the parameter vector, i.e.
+    only on the parameters the residual of this sample depends on. So the
+    residual and the jacobian at the same point only solve the NUM problem
+    once, and a point that only moves other parameters (e.g. a finite
+    difference probe of another column) reuses them without a solve.
+    avoided counts the hits of the latter kind.
+
+    A, c, alpha, x, p0_idx, spherical: see ErrorFunc
+    cache_size: the number of parameter points to remember
+    solver: the NUM solver, see SelectSolver
+    """
+
+    def __init__(self, A, c, alpha, x, p0_idx=None, spherical=True,
+                 cache_size=4, solver='auto'):
+        self.A = A
+        self.c = np.array(c, dtype=float)
+        self.alpha = np.array(alpha, dtype=float)
+        self.x = np.array(x, dtype=float).flatten()
+        if p0_idx is None:
+            p0_idx = range(len(alpha))
+        self.p0_idx = list(p0_idx)
+        self.rho_idx = self.p0_idx
+        self.spherical = spherical
+        self.solver = solver if solver == 'auto' else SelectSolver(A, solver)
+        self.symmetry = Symmetry(A, self.alpha, self.p0_idx)
+        self.components = Components(self.symmetry.A)
+
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.avoided = 0
+        self.warm = WarmStart()
+        self.footprints = {}
+
+    def lookup(self, p):
+        """
+        Return the cache entry [p, p0, x_esti, la_esti, jac] of the point p,
+        solving the NUM problem if the footprint of p is not cached. The p of
+        the entry is the point that was solved, and jac is None until jac()
+        is called.
+        """
+        p = np.asarray(p, dtype=float)
+        P = len(p)
+        if P not in self.footprints:
+            self.footprints[P] = self.footprint(P)
+        key = p[self.footprints[P]].tobytes()
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            entry = self.cache[key]
+            if not np.array_equal(entry[0], p):
+                self.avoided += 1
+            return entry
+
+        self.misses += 1
+        p0 = Spherical2Cartesian(p) if self.spherical else p
+        x_esti, la_esti = EstimateX(self.A, self.c, self.alpha, p0, self.x,
+                                    self.p0_idx, spherical=False,
+                                    warm=self.warm, solver=self.solver,
+                                    symmetry=self.symmetry,
+                                    components=self.components)
+        entry = [p.copy(), p0, x_esti, la_esti, None]
+        self.cache[key] = entry
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return entry
+
+    def equilibrium(self, p):
+        """
+        Return (p0, x_esti, la_esti) where p0 is the cartesian form of p.
+        Note that a cached p0 may be the one of another point with the same
+        footprint, which has the same NUM solution.
+        """
+        return tuple(self.lookup(p)[1:4])
+
+    def remap(self, active):
+        """
+        Index the parameters by the position of the scaling factors of
+        rho_idx, the p0_idx given at first, in the sorted active ones, see
+        ActiveIndex. The cache is dropped, as the parameters change meaning.
+        """
+        self.p0_idx = list(np.searchsorted(active, self.rho_idx))
+        self.cache.clear()
+        self.footprints = {}
+
+    def footprint(self, P):
+        """
+        Return the indices of the P parameters the residual of this sample
+        depends on.
+        """
+        idx = np.unique(self.p0_idx)
+        if not self.spherical:
+            return idx
+        if len(idx) < 2:
+            return np.arange(0)
+        # rho[i] = cos(theta[i]) * prod(sin(theta[:i])) (no cos for the last
+        # one), and the NUM solution does not change when all the scaling
+        # factors are multiplied by the same constant. So the residual only
+        # depends on the ratios of the referenced scaling factors, i.e. on
+        # theta[min(idx)..max(idx)].
+        return np.arange(idx[0], min(idx[-1], P-1) + 1)
+
+    def error(self, p):
+        _, x_esti, _ = self.equilibrium(p)
+        # abs_err = x_esti - x
+        # rel_err = abs_err / x
+        # x_err = np.linalg.norm((x_esti - x)/x)**2
+        return x_esti - self.x
+
+    def jac(self, p):
+        entry = self.lookup(p)
+        if entry[4] is not None:
+            return entry[4]
+        p, p0, x_esti, la_esti = entry[:4]
+        DWX = Sensitivity(self.A, self.c, self.alpha, p0, x_esti, la_esti,
+                          self.p0_idx)
+
+        # Update p0
+        # dp = (x_esti/x - 1) / x * DWX
+        dp = DWX
+        if self.spherical:
+            # At the solved point, the columns out of the footprint are only
+            # rounding errors, so the rows hold for the whole footprint
+            dp = SphericalJacDot(p, dp)
+        entry[4] = dp
+        return dp
+
+def CacheStats(evaluators):
+    """
+    Return the total (hits, avoided, misses) of the NUM caches of the
+    evaluators (or of their SampleStats), see SampleEvaluator.
+    """
+    hits = sum(ev.hits for ev in evaluators)
+    avoided = sum(ev.avoided for ev in evaluators)
+    misses = sum(ev.misses for ev in evaluators)
+    return hits, avoided, misses
+
+def JacSparsity(evaluators, P):
+    """
+    Return the sparsity structure of the jacobian of the stacked residuals of
+    the evaluators with respect to the P parameters.
+    """
+    rows, cols = [], []
+    offset = 0
+    for ev in evaluators:
+        J = len(ev.x)
+        fp = ev.footprint(P)
+        rows.append(np.repeat(np.arange(offset, offset + J), len(fp)))
+        cols.append(np.tile(fp, J))
+        offset += J
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=int)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=int)
+    return sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(offset, P))
+
+class SampleSet(object):
+    """
+    Stack the residuals and the jacobians of a list of SampleEvaluators.
+
+    The row offset of each sample is computed once, and each evaluation
+    writes the per-sample blocks into one output buffer of the final size.
+    A new buffer is used on every call since least_squares keeps the
+    previous residual and jacobian around.
+
+    evaluators: a list of SampleEvaluator
+    sparse: return the jacobian as a scipy.sparse matrix, only keeping the
+            footprint columns of each sample
+    """
+
+    def __init__(self, evaluators, sparse=False):
+        self.evaluators = evaluators
+        self.S = len(evaluators)
+        self.sparse = sparse
+        self.offsets = np.cumsum([0] + [len(ev.x) for ev in evaluators])
+
+    def add(self, evaluators):
+        """
+        Append more SampleEvaluators to the set.
+        """
+        self.evaluators = self.evaluators + list(evaluators)
+        self.S = len(self.evaluators)
+        self.offsets = np.cumsum([0] + [len(ev.x) for ev in self.evaluators])
+
+    def blocks(self, method, p):
+        """
+        Return method(p) of every evaluator, in the order of the samples.
+        """
+        return [getattr(ev, method)(p) for ev in self.evaluators]
+
+    def error(self, p):
+        out = np.empty(self.offsets[-1])
+        for i, block in enumerate(self.blocks('error', p)):
+            out[self.offsets[i]:self.offsets[i+1]] = block
+        return out
+
+    def jac(self, p):
+        P = len(p)
+        blocks = self.blocks('jac', p)
+        if not self.sparse:
+            out = np.empty((self.offsets[-1], P))
+            for i, block in enumerate(blocks):
+                out[self.offsets[i]:self.offsets[i+1]] = block
+            return out
+
+        fps = [ev.footprint(P) for ev in self.evaluators]
+        nnz = np.cumsum([0] + [len(self.evaluators[i].x) * len(fps[i])
+                               for i in range(self.S)])
+        data = np.empty(nnz[-1])
+        indices = np.empty(nnz[-1], dtype=int)
+        indptr = np.empty(self.offsets[-1] + 1, dtype=int)
+        indptr[0] = 0
+        for i, block in enumerate(blocks):
+            J, F = len(self.evaluators[i].x), len(fps[i])
+            data[nnz[i]:nnz[i+1]] = block[:, fps[i]].ravel()
+            indices[nnz[i]:nnz[i+1]] = np.tile(fps[i], J)
+            indptr[self.offsets[i]+1:self.offsets[i+1]+1] = \
+                nnz[i] + F * np.arange(1, J+1)
+        return sp.csr_matrix((data, indices, indptr),
+                             shape=(self.offsets[-1], P))
+
+    def remap(self, active):
+        """
+        Remap the parameters of every evaluator, see SampleEvaluator.remap.
+        """
+        for ev in self.evaluators:
+            ev.remap(active)
+
+    def stats(self):
+        return self.evaluators
+
+    def close(self):
+        pass
+
+SampleStats = namedtuple('SampleStats', ['hits', 'avoided', 'misses', 'warm'])
+
+def SampleWorker(conn, evaluators):
+    """
+    The main loop of a SamplePool worker.
+    """
+    while True:
+        method, p = conn.recv()
+        if method is None:
+            break
+        try:
+            if method == 'stats':
+                ret = [SampleStats(ev.hits, ev.avoided, ev.misses, ev.warm)
+                       for ev in evaluators]
+            elif method == 'add':
+                evaluators.extend(p)
+                ret = None
+            else:
+                ret = [getattr(ev, method)(p) for ev in evaluators]
+        except Exception as e:
+            ret = e
+        conn.send(ret)
+    conn.close()
+
+class SamplePool(SampleSet):
+    """
+    A SampleSet evaluated in a persistent pool of worker processes.
+
+    The samples are sharded across the workers once and stay resident there
+    together with their NUM caches and warm starts, so only the parameter
+    vector and the results cross the process boundary on each call.
+
+    evaluators: a list of SampleEvaluator
+    workers: the number of worker processes. They are all started, even
+             with fewer samples, as add() gives the new samples to the
+             least loaded ones.
+    """
+
+    def __init__(self, evaluators, workers, sparse=False):
+        SampleSet.__init__(self, evaluators, sparse)
+        workers = max(1, workers)
+
+        # Balance the shards by the number of flows of each sample
+        self.shards = [[] for w in range(workers)]
+        self.load = [0] * workers
+        for i in sorted(range(self.S), key=lambda i: -len(evaluators[i].x)):
+            w = self.load.index(min(self.load))
+            self.shards[w].append(i)
+            self.load[w] += len(evaluators[i].x)
+
+        self.conns = []
+        self.procs = []
+        for shard in self.shards:
+            conn, child_conn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(
+                target=SampleWorker,
+                args=(child_conn, [evaluators[i] for i in shard]))
+            proc.daemon = True
+            proc.start()
+            child_conn.close()
+            self.conns.append(conn)
+            self.procs.append(proc)
+
+    def add(self, evaluators):
+        """
+        Append more SampleEvaluators, each to the least loaded worker.
+        """
+        evaluators = list(evaluators)
+        new = [[] for conn in self.conns]
+        for i, ev in enumerate(evaluators):
+            w = self.load.index(min(self.load))
+            self.shards[w].append(self.S + i)
+            new[w].append(ev)
+            self.load[w] += len(ev.x)
+        SampleSet.add(self, evaluators)
+        for conn, evs in zip(self.conns, new):
+            if evs:
+                conn.send(('add', evs))
+                conn.recv()
+
+    def blocks(self, method, p=None):
+        for conn in self.conns:
+            conn.send((method, p))
+        ret = [None] * self.S
+        errors = []
+        for conn, shard in zip(self.conns, self.shards):
+            res = conn.recv()
+            if isinstance(res, Exception):
+                errors.append(res)
+                continue
+            for i, r in zip(shard, res):
+                ret[i] = r
+        if errors:
+            raise errors[0]
+        return ret
+
+    def remap(self, active):
+        # The local copies give the footprints of the jacobian sparsity
+        SampleSet.remap(self, active)
+        self.blocks('remap', active)
+
+    def stats(self):
+        return self.blocks('stats')
+
+    def close(self):
+        for conn in self.conns:
+            conn.send((None, None))
+            conn.close()
+        for proc in self.procs:
+            proc.join()
 
 def Estimate(A, c, alpha, p0, x, p0_idx=None,
-             iter=100, tol=0.01, step=0.01*np.pi, spherical=True):
+             iter=100, tol=0.01, step=0.01*np.pi, spherical=True,
+             solver='auto'):
     J = len(alpha) # The number of flows
     p0_idx = p0_idx or range(J)
     p0_bound = ([1e-6]*len(p0), [np.pi/2-1e-6]*len(p0))
 
-    error_func = lambda p: ErrorFunc(A, c, alpha, p, x, p0_idx, spherical)
-    error_jac = lambda p: ErrorJac(A, c, alpha, p, x, p0_idx, spherical)
-    res = least_squares(error_func, p0, jac=error_jac, bounds=p0_bound)
+    evaluator = SampleEvaluator(A, c, alpha, x, p0_idx, spherical,
+                                solver=solver)
+    res = least_squares(evaluator.error, p0, jac=evaluator.jac,
+                        bounds=p0_bound)
     p_esti = res.x
     err = res.cost
 
     # print('Final Result: ', p_esti, err)
     return p_esti, err
 
-def RoutingMatrix(flows):
+def RoutingMatrix(flows, keys=False):
+    """
+    Build the routing matrix of the flows on the access links of the Clos
+    topology, as a scipy.sparse CSR matrix with one row per link.
+
+    keys: also return the link of each row, as a (pod, edge, host, dir)
+          tuple with dir 0 for the uplink of the host and 1 for its downlink
+
+    A link whose set of flows is contained in the set of flows of another
+    link can never be the only bottleneck and is dropped, and only one of the
+    links carrying the same set of flows is kept. Each flow only traverses
+    its source and destination links, so a link is only compared with the
+    links of one of its flows, which keeps the construction near-linear in
+    the number of flows.
+    """
     links = {}
-    F = len(flows)
-    for i in range(F):
+    flow_links = []
+    for i in range(len(flows)):
         f = flows[i]
         slink = tuple(f['from'] + [0])
-        if slink not in links.keys():
-            links[slink] = np.zeros(F)
-        rflows = links[slink]
-        rflows[i] = 1
         dlink = tuple(f['to'] + [1])
-        if dlink not in links.keys():
-            links[dlink] = np.zeros(F)
-        rflows = links[dlink]
-        rflows[i] = 1
-
-    A = []
-    signal = lambda l, lp: (1 in l-lp) + 2*(-1 in l-lp)
-
-    _links = list(links.keys())
-    while _links:
-        k = _links.pop()
+        links.setdefault(slink, set()).add(i)
+        links.setdefault(dlink, set()).add(i)
+        flow_links.append((slink, dlink))
+    links = {k: frozenset(v) for k, v in links.items()}
+
+    rows = []
+    row_keys = []
+    kept = set()
+    for k in reversed(list(links.keys())):
         l = links[k]
-        valid = True
-        for kp in _links:
-            lp = links[kp]
-            s = signal(l, lp)
-            if s < 2:
-                _links.remove(kp)
-            elif s == 2:
-                valid = False
-                break
-        if valid:
-            A.append(l)
+        if l in kept:
+            continue
+        f0 = next(iter(l))
+        if any(len(links[kp]) > len(l) and l < links[kp]
+               for kp in flow_links[f0]):
+            continue
+        kept.add(l)
+        rows.append(sorted(l))
+        row_keys.append(k)
+
+    indptr = np.cumsum([0] + [len(l) for l in rows])
+    indices = np.array([i for l in rows for i in l], dtype=int)
+    A = sp.csr_matrix((np.ones(len(indices)), indices, indptr),
+                      shape=(len(rows), len(flows)))
+    if keys:
+        return A, row_keys
+    return A
+
+def PodBlocks(A, keys, blocks):
+    """
+    Partition the links by pod into at most `blocks` groups of pods, with
+    the pods balanced by the number of flows on their links.
 
-    return np.mat(A)
+    A, keys: the routing matrix and the link keys from RoutingMatrix
+    Return the group of each row of A.
+    """
+    A = sp.csr_matrix(A)
+    pod_of = np.array([k[0] for k in keys], dtype=int)
+    pods, pod_of = np.unique(pod_of, return_inverse=True)
+    pod_load = np.bincount(pod_of, weights=np.diff(A.indptr),
+                           minlength=len(pods))
+    blocks = max(1, min(blocks, len(pods)))
+
+    group = np.zeros(len(pods), dtype=int)
+    load = [0] * blocks
+    for p in np.argsort(-pod_load, kind='stable'):
+        b = load.index(min(load))
+        group[p] = b
+        load[b] += pod_load[p]
+    return group[pod_of]
+
+def LinkBlocks(A, blocks):
+    """
+    Partition the links into at most `blocks` groups when their keys are not
+    known, see PodBlocks. The links are ordered by reverse Cuthill-McKee on
+    the link graph, where two links are adjacent when they share a flow, so
+    that the neighbouring links come together, and cut into consecutive
+    groups balanced by the number of flows on their links.
+
+    Return the group of each row of A.
+    """
+    A = sp.csr_matrix(A)
+    M = A.shape[0]
+    if not M:
+        return np.zeros(0, dtype=int)
+    blocks = max(1, min(blocks, M))
+    order = reverse_cuthill_mckee(A.dot(A.T).tocsr(), symmetric_mode=True)
+    load = np.diff(A.indptr)[order]
+    before = np.cumsum(load) - load
+    group = np.empty(M, dtype=int)
+    group[order] = np.minimum(before * blocks // max(load.sum(), 1),
+                              blocks - 1)
+    return np.unique(group, return_inverse=True)[1]
 
 def RhoIndex(flows, K, method='sender-hc'):
     K2 = K//2
@@ -333,10 +1255,11 @@ def RhoIndex(flows, K, method='sender-hc'):
             rho_idx[i] = tcp_idx[tcp] * T + hc
     return rho_idx
 
-def Train(samples, K=4, theta=None):
+def Train(samples, K=4, theta=None, solver='auto'):
     """
     samples: A list of samples.
     K: The scale of Clos topology. (default: 4)
+    solver: The NUM solver, see SelectSolver. (default: auto)
 
     A sample should be the following format:
 
@@ -345,6 +1268,7 @@ def Train(samples, K=4, theta=None):
       "rates": []  // The equilibrium bandwidth of each flow
     }
     """
+    CheckSamplesK(samples, K)
     K2 = K//2
     K = K2*2
     RHO = K * K2 * K2 * 3
@@ -360,85 +1284,286 @@ def Train(samples, K=4, theta=None):
         alpha = [TCP_ALPHA[flows[i]['tcp']] for i in range(F)]
         rho_idx = RhoIndex(flows, K)
 
-        theta, err = Estimate(A, c, alpha, theta, x, p0_idx=rho_idx)
+        theta, err = Estimate(A, c, alpha, theta, x, p0_idx=rho_idx,
+                              solver=solver)
         print(RED('Total relative error = %s' % (err)))
     rho = Spherical2Cartesian(theta)
     return rho, theta
 
-def Predict(flows, rho, K=4):
+def Predict(flows, rho, K=4, warm=None, solver='auto', workers=1):
+    """
+    warm: an optional WarmStart kept by the caller for this query
+    solver: the NUM solver, see SelectSolver. With 'consensus', the links
+            are split into `workers` blocks of pods, see PodBlocks.
+    workers: the number of processes to solve the large independent groups
+             of flows with
+    """
     K2 = K//2
     K = K2*2
-    A = RoutingMatrix(flows)
+    A, keys = RoutingMatrix(flows, keys=True)
     L, F = A.shape
     c = [1] * L
     alpha = [TCP_ALPHA[flows[i]['tcp']] for i in range(F)]
     rho_idx = RhoIndex(flows, K)
     x0 = np.array([1.]*F) / F
 
-    x, la = EstimateX(A, c, alpha, rho, x0, p0_idx=rho_idx, spherical=False, disp=2)
+    if solver == 'consensus':
+        x, la = SolveConsensus(A, c, alpha, np.asarray(rho)[rho_idx],
+                               blocks=PodBlocks(A, keys, workers))
+        return x
+
+    x, la = EstimateX(A, c, alpha, rho, x0, p0_idx=rho_idx, spherical=False,
+                      disp=2, warm=warm, solver=solver, workers=workers)
     return x
 
+def SampleEvaluators(As, cs, alphas, xs, p0_idxs=None, spherical=True,
+                     solver='auto'):
+    S = len(As)
+    p0_idxs = p0_idxs or [None] * S
+    return [SampleEvaluator(As[i], cs[i], alphas[i], xs[i], p0_idxs[i],
+                            spherical, solver=solver)
+            for i in range(S)]
+
 def ErrorFuncNg(As, cs, alphas, p0, xs, p0_idxs=None, spherical=True):
-    x_err = np.array([])
-    for i in range(len(As)):
-        A = As[i]
-        c = cs[i]
-        alpha = alphas[i]
-        x = xs[i]
-        p0_idx = p0_idxs[i]
-        x_err = np.append(x_err, ErrorFunc(A, c, alpha, p0, x, p0_idx, spherical))
-    return x_err
+    evaluators = SampleEvaluators(As, cs, alphas, xs, p0_idxs, spherical)
+    return SampleSet(evaluators).error(p0)
 
 def ErrorJacNg(As, cs, alphas, p0, xs, p0_idxs=None, spherical=True):
-    dp = np.zeros((0, len(p0)))
-    for i in range(len(As)):
-        A = As[i]
-        c = cs[i]
-        alpha = alphas[i]
-        x = xs[i]
-        p0_idx = p0_idxs[i]
-        dp = np.append(dp, ErrorJac(A, c, alpha, p0, x, p0_idx, spherical), axis=0)
-    return dp
+    evaluators = SampleEvaluators(As, cs, alphas, xs, p0_idxs, spherical)
+    return SampleSet(evaluators).jac(p0)
 
 def EstimateNg(As, cs, alphas, p0, xs, p0_idxs=None,
                iter=100, tol=0.01, step=0.01*np.pi, spherical=True,
-               custom_gradient=True):
-    S = len(As)
-    p0_idxs = p0_idxs or [None] * S
-    p0_bound = ([1e-6]*len(p0), [np.pi/2-1e-6]*len(p0))
-
-    error_func = lambda p: ErrorFuncNg(As, cs, alphas, p, xs, p0_idxs, spherical)
-    error_jac = lambda p: ErrorJacNg(As, cs, alphas, p, xs, p0_idxs, spherical)
-    if custom_gradient:
-        res = least_squares(error_func, p0, jac=error_jac, bounds=p0_bound)
+               custom_gradient=True, workers=1, sparse_jac=False,
+               solver='auto', optimizer='lsq', options=None):
+    """
+    workers: the number of processes to evaluate the samples with
+    sparse_jac: return the custom jacobian as a scipy.sparse matrix
+    solver: the NUM solver, see SelectSolver
+    optimizer: 'lsq' to fit all the samples at once with least_squares, or
+               a stochastic optimizer on mini-batches of samples for large
+               corpora, see StochasticFit. The stochastic optimizers always
+               use the custom gradient and run in this process.
+    options: a dict of the keyword arguments of StochasticFit
+    """
+    evaluators = SampleEvaluators(As, cs, alphas, xs, p0_idxs, spherical,
+                                  solver)
+    if optimizer != 'lsq':
+        return StochasticFit(evaluators, p0, optimizer, **(options or {}))
+    if workers > 1 and len(evaluators) > 1:
+        samples = SamplePool(evaluators, min(workers, len(evaluators)),
+                             sparse_jac)
     else:
-        res = least_squares(error_func, p0, bounds=p0_bound)
+        samples = SampleSet(evaluators, sparse_jac)
+    try:
+        res = FitSamples(samples, p0, custom_gradient)
+    finally:
+        samples.close()
     p_esti = res.x
     err = res.cost
 
     # print('Final Result: ', p_esti, err)
     return p_esti, err
 
-def TrainNg(samples, K=4, theta=None, custom_gradient=True):
+# The default learning rates of the stochastic optimizers
+STOCHASTIC_LR = {'adam': 0.01, 'sgd': 5.0, 'sgn': 0.5}
+
+def StochasticFit(evaluators, p0, optimizer='adam', batch_size=16, epochs=20,
+                  lr=None, holdout=0.1, patience=3, tol=1e-4, damping=0.1,
+                  max_step=0.1, seed=None):
+    """
+    Fit the spherical parameters to the SampleEvaluators from p0 with a
+    stochastic optimizer. Each step draws a mini-batch of samples and uses
+    their residuals and jacobians only:
+
+        adam: Adam on the gradient J^T r
+        sgd: plain gradient descent on J^T r divided by the batch flows
+        sgn: stochastic Gauss-Newton, damped steps (J^T J + mu D)^-1 J^T r
+             with D the diagonal of J^T J and mu = damping
+
+    The steps are scaled by lr (STOCHASTIC_LR by default), each element is
+    clipped to max_step and theta is kept within its bounds. A slice of
+    holdout of the samples is left out, and its cost is checked after each
+    epoch: the fit stops when it has not improved by a relative tol for
+    patience epochs, and the best theta on the slice is returned.
+
+    Return (theta, cost) with the cost of all the samples at theta.
+    """
+    lo, hi = 1e-6, np.pi/2-1e-6
+    p = np.clip(np.array(p0, dtype=float), lo, hi)
+    if lr is None:
+        lr = STOCHASTIC_LR[optimizer]
+    rng = np.random.RandomState(seed)
+    order = rng.permutation(len(evaluators))
+    H = int(round(holdout * len(evaluators))) if len(evaluators) > 1 else 0
+    held = SampleSet([evaluators[i] for i in order[:H]])
+    train = order[H:]
+
+    def cost(samples, p):
+        r = samples.error(p)
+        return 0.5 * np.dot(r, r)
+
+    m = np.zeros(len(p))
+    v = np.zeros(len(p))
+    t = 0
+    JJ = None
+    best = (cost(held, p) if H else np.inf, p)
+    stall = 0
+    for epoch in range(epochs):
+        rng.shuffle(train)
+        for b in range(0, len(train), batch_size):
+            batch = SampleSet([evaluators[i] for i in train[b:b+batch_size]])
+            r = batch.error(p)
+            J = batch.jac(p)
+            g = J.T.dot(r)
+            if optimizer == 'adam':
+                t += 1
+                m = 0.9 * m + 0.1 * g
+                v = 0.999 * v + 0.001 * g * g
+                step = lr * (m / (1 - 0.9**t)) / \
+                    (np.sqrt(v / (1 - 0.999**t)) + 1e-8)
+            elif optimizer == 'sgd':
+                step = lr * g / len(r)
+            elif optimizer == 'sgn':
+                n = len(r)
+                JJ = J.T.dot(J) / n if JJ is None else \
+                    0.9 * JJ + 0.1 * J.T.dot(J) / n
+                D = np.diag(JJ) + 1e-12
+                step = lr * np.linalg.solve(JJ + damping * np.diag(D), g / n)
+            else:
+                raise ValueError('Unknown optimizer: %s' % optimizer)
+            step = np.clip(step, -max_step, max_step)
+            p = np.clip(p - step, lo, hi)
+
+        if not H:
+            continue
+        c = cost(held, p)
+        print('Epoch %d: held-out cost = %s' % (epoch + 1, c))
+        if c < best[0] * (1 - tol):
+            best = (c, p)
+            stall = 0
+        else:
+            if c < best[0]:
+                best = (c, p)
+            stall += 1
+            if stall >= patience:
+                break
+
+    if H:
+        p = best[1]
+    err = cost(SampleSet(evaluators), p)
+    print('NUM cache: %d hits (%d solves avoided), %d misses'
+          % CacheStats(evaluators))
+    print(WarmStart().merge([ev.warm for ev in evaluators]).report())
+    return p, err
+
+def FitSamples(samples, p0, custom_gradient=True, max_nfev=None):
+    """
+    Fit the spherical parameters to a SampleSet (or SamplePool) from p0 with
+    least_squares, and print the NUM cache and warm start statistics.
+
+    max_nfev: the maximum number of residual evaluations, see least_squares
+
+    Return the result of least_squares.
+    """
+    p0_bound = ([1e-6]*len(p0), [np.pi/2-1e-6]*len(p0))
+    p0 = np.clip(p0, *p0_bound)
+    if custom_gradient:
+        res = least_squares(samples.error, p0, jac=samples.jac,
+                            bounds=p0_bound, max_nfev=max_nfev)
+    else:
+        # Only the grouped perturbations of independent columns
+        sparsity = JacSparsity(samples.evaluators, len(p0))
+        res = least_squares(samples.error, p0, bounds=p0_bound,
+                            jac_sparsity=sparsity, max_nfev=max_nfev)
+    stats = samples.stats()
+    print('NUM cache: %d hits (%d solves avoided), %d misses'
+          % CacheStats(stats))
+    print(WarmStart().merge([ev.warm for ev in stats]).report())
+    return res
+
+def CompileSample(flows, rates, K=4):
+    """
+    Turn a sample into the (A, c, alpha, x, rho_idx) tuple the estimator
+    works on.
+    """
+    A = RoutingMatrix(flows)
+    L, F = A.shape
+    c = [1] * L
+    alpha = [TCP_ALPHA[flows[i]['tcp']] for i in range(F)]
+    rho_idx = RhoIndex(flows, K)
+    return A, c, alpha, rates, rho_idx
+
+def CheckSamplesK(samples, K):
+    """
+    Raise a ValueError if the samples were compiled for another topology
+    size than K, e.g. a dataset.Dataset, as their rho_idx would then refer
+    to other scaling factors.
+    """
+    K_samples = getattr(samples, 'K', None)
+    if K_samples is not None and K_samples//2 != K//2:
+        raise ValueError('The samples are compiled for K = %d, not %d'
+                         % (K_samples, K))
+
+def CompileEvaluator(sample, K=4, solver='auto'):
+    """
+    Return the SampleEvaluator of a sample, see TrainNg.
+    """
+    if isinstance(sample, dict):
+        sample = CompileSample(sample['flows'], sample['rates'], K)
+    A, c, alpha, x, rho_idx = sample
+    return SampleEvaluator(A, c, alpha, x, rho_idx, solver=solver)
+
+def ActiveIndex(rho_idxs):
+    """
+    Return the sorted scaling factors referenced by the samples, and the
+    rho_idx of each sample as positions in them.
+    """
+    active = np.unique(np.concatenate([np.asarray(idx, dtype=int)
+                                       for idx in rho_idxs] or [[]]))
+    return active, [np.searchsorted(active, idx) for idx in rho_idxs]
+
+def ExpandRho(rho_active, active, rho):
+    """
+    Put the fitted scaling factors of the active entries back into the full
+    vector rho. As the NUM solution does not change when the scaling factors
+    are multiplied by the same constant, rho_active is scaled to the norm of
+    the entries it replaces, so the others are kept as they are.
+    """
+    rho = np.array(rho, dtype=float)
+    rho[active] = rho_active * np.linalg.norm(rho[active]) / \
+        np.linalg.norm(rho_active)
+    return rho
+
+def TrainNg(samples, K=4, theta=None, custom_gradient=True, workers=1,
+            solver='auto', optimizer='lsq', options=None, prune=True):
+    """
+    samples: A list of samples, see Train(). A sample can also be an already
+             compiled (A, c, alpha, x, rho_idx) tuple, e.g. from a
+             dataset.Dataset, which must be compiled for the same K.
+    solver: The NUM solver, see SelectSolver. (default: auto)
+    optimizer, options: The optimizer and its options, see EstimateNg.
+                        (default: lsq)
+    prune: Only fit the scaling factors the samples refer to, in their own
+           spherical coordinates, and leave the others as in theta.
+           (default: True)
+    """
+    CheckSamplesK(samples, K)
     K2 = K//2
     K = K2*2
     RHO = K * K2 * K2 * 3
     # theta = np.pi/2 * np.random.random(RHO)
     if (type(theta) == np.ndarray and len(theta)) or not theta:
-        theta = [np.arccos(1/np.sqrt(i)) for i in range(RHO, 1, -1)]
+        theta = InitialTheta(K)
     As = []
     cs = []
     alphas = []
     xs = []
     rho_idxs = []
     for sample in samples:
-        flows = sample['flows']
-        x = sample['rates']
-        A = RoutingMatrix(flows)
-        L, F = A.shape
-        c = [1] * L
-        alpha = [TCP_ALPHA[flows[i]['tcp']] for i in range(F)]
-        rho_idx = RhoIndex(flows, K)
+        if isinstance(sample, dict):
+            sample = CompileSample(sample['flows'], sample['rates'], K)
+        A, c, alpha, x, rho_idx = sample
 
         As.append(A)
         cs.append(c)
@@ -446,11 +1571,224 @@ def TrainNg(samples, K=4, theta=None, custom_gradient=True):
         xs.append(x)
         rho_idxs.append(rho_idx)
 
-    theta, err = EstimateNg(As, cs, alphas, theta, xs, p0_idxs=rho_idxs, step=0.001*np.pi, custom_gradient=custom_gradient)
+    active, active_idxs = ActiveIndex(rho_idxs)
+    if prune and 1 < len(active) < RHO:
+        rho = Spherical2Cartesian(theta)
+        theta_active = Cartesian2Spherical(rho[active])
+        theta_active, err = EstimateNg(As, cs, alphas, theta_active, xs, p0_idxs=active_idxs, step=0.001*np.pi, custom_gradient=custom_gradient, workers=workers, solver=solver, optimizer=optimizer, options=options)
+        rho = ExpandRho(Spherical2Cartesian(theta_active), active, rho)
+        theta = Cartesian2Spherical(rho)
+        print(RED('Total relative error = %s' % (err)))
+        return rho, theta, err
+
+    theta, err = EstimateNg(As, cs, alphas, theta, xs, p0_idxs=rho_idxs, step=0.001*np.pi, custom_gradient=custom_gradient, workers=workers, solver=solver, optimizer=optimizer, options=options)
     print(RED('Total relative error = %s' % (err)))
     rho = Spherical2Cartesian(theta)
     return rho, theta, err
 
+def InitialTheta(K=4):
+    """
+    Return the spherical parameters of equal scaling factors for a Clos
+    topology of size K.
+    """
+    K2 = K//2
+    K = K2*2
+    RHO = K * K2 * K2 * 3
+    return [np.arccos(1/np.sqrt(i)) for i in range(RHO, 1, -1)]
+
+# The default number of residual evaluations of Trainer.partial_fit
+TRAINER_REFINE = 5
+
+class Trainer(object):
+    """
+    Train the scaling factors on a growing list of samples.
+
+    TrainNg compiles and solves every sample again, from a cold start, each
+    time it is called. A Trainer keeps the SampleEvaluator of each sample,
+    with its routing matrix, NUM cache and last equilibrium, together with
+    the current theta. partial_fit() only compiles the new samples and
+    refines theta from where the previous fit stopped, so the old samples
+    are solved from warm starts close to their equilibria.
+
+    K, custom_gradient, workers, solver, prune: see TrainNg
+    theta: the starting point of fit(), equal scaling factors by default
+    refine: the maximum number of residual evaluations of partial_fit(), or
+            None to run least_squares to convergence. The old samples were
+            fitted already, so a few steps are enough to take the new ones
+            in. (default: TRAINER_REFINE)
+    """
+
+    def __init__(self, K=4, theta=None, custom_gradient=True, workers=1,
+                 solver='auto', refine=TRAINER_REFINE, prune=True):
+        K2 = K//2
+        self.K = K2*2
+        self.theta0 = InitialTheta(self.K) if theta is None else theta
+        self.theta = np.array(self.theta0, dtype=float)
+        self.custom_gradient = custom_gradient
+        self.workers = workers
+        self.solver = solver
+        self.refine = refine
+        self.prune = prune
+        self.active = np.arange(len(self.theta) + 1)
+        self.rho_idxs = []
+        self.err = None
+        self.samples = None
+
+    def __len__(self):
+        return self.samples.S if self.samples is not None else 0
+
+    def add(self, samples):
+        """
+        Compile and append the samples, see TrainNg, without training.
+        """
+        CheckSamplesK(samples, self.K)
+        evaluators = [CompileEvaluator(sample, self.K, self.solver)
+                      for sample in samples]
+        self.rho_idxs += [ev.rho_idx for ev in evaluators]
+        active = np.arange(len(self.theta) + 1)
+        if self.prune:
+            pruned = ActiveIndex(self.rho_idxs)[0]
+            if len(pruned) > 1:
+                active = pruned
+        changed = not np.array_equal(active, self.active)
+        self.active = active
+        for ev in evaluators:
+            ev.remap(active)
+        if self.samples is None:
+            if self.workers > 1:
+                self.samples = SamplePool(evaluators, self.workers)
+            else:
+                self.samples = SampleSet(evaluators)
+        else:
+            if changed:
+                self.samples.remap(active)
+            self.samples.add(evaluators)
+
+    def optimize(self, max_nfev=None):
+        if not len(self):
+            return Spherical2Cartesian(self.theta), self.theta, self.err
+        if len(self.active) == len(self.theta) + 1:
+            res = FitSamples(self.samples, self.theta, self.custom_gradient,
+                             max_nfev)
+            self.theta = res.x
+        else:
+            # Only fit the active scaling factors, see TrainNg
+            rho = Spherical2Cartesian(self.theta)
+            res = FitSamples(self.samples,
+                             Cartesian2Spherical(rho[self.active]),
+                             self.custom_gradient, max_nfev)
+            rho = ExpandRho(Spherical2Cartesian(res.x), self.active, rho)
+            self.theta = Cartesian2Spherical(rho)
+        self.err = res.cost
+        print(RED('Total relative error = %s' % (self.err)))
+        return Spherical2Cartesian(self.theta), self.theta, self.err
+
+    def fit(self, samples):
+        """
+        Train on the samples only, from the initial theta.
+
+        Return (rho, theta, err) like TrainNg.
+        """
+        self.close()
+        self.theta = np.array(self.theta0, dtype=float)
+        self.add(samples)
+        return self.optimize()
+
+    def partial_fit(self, samples, final=False):
+        """
+        Add the samples to the ones already seen, and refine theta.
+
+        final: fit theta to convergence instead of the refine steps, e.g.
+               for the model which is used after the last samples
+
+        Return (rho, theta, err) like TrainNg.
+        """
+        self.add(samples)
+        return self.optimize(None if final else self.refine)
+
+    def close(self):
+        """
+        Drop the samples, and stop the worker processes if any.
+        """
+        if self.samples is not None:
+            self.samples.close()
+            self.samples = None
+        self.active = np.arange(len(self.theta) + 1)
+        self.rho_idxs = []
+
+class OnlineTrainer(object):
+    """
+    Estimate theta from a stream of samples, one update per sample, with a
+    recursive Gauss-Newton (RLS) step on the residual and the sensitivity
+    of the new sample only:
+
+        G = C J^T (forget I + J C J^T)^-1
+        theta = theta - G r
+        C = (C - G J C) / forget
+
+    C is the PxP covariance of theta, so an update costs O(P^2 J) for a
+    sample of J flows, whatever the number of samples seen before. The
+    forgetting factor discounts the old samples, so that theta can follow a
+    drift of the scaling factors.
+
+    K, solver: see TrainNg
+    theta: the starting point, equal scaling factors by default
+    forget: the forgetting factor in (0, 1], 1 to weigh all samples alike
+    delta: the initial variance of theta, i.e. how far the first samples
+           may move it
+    max_step: the largest change of a single element of theta in one update
+    iters: the number of Gauss-Newton steps per sample, relinearized at the
+           updated theta
+    """
+
+    def __init__(self, K=4, theta=None, forget=0.99, delta=1.0, max_step=0.1,
+                 iters=1, solver='auto'):
+        K2 = K//2
+        self.K = K2*2
+        self.theta = np.array(InitialTheta(self.K) if theta is None
+                              else theta, dtype=float)
+        P = len(self.theta)
+        self.C = delta * np.eye(P)
+        if iters < 1:
+            raise ValueError('OnlineTrainer needs iters >= 1: %s' % iters)
+        self.forget = forget
+        self.max_step = max_step
+        self.iters = iters
+        self.solver = solver
+        self.bounds = (1e-6, np.pi/2-1e-6)
+        self.updates = 0
+
+    def update(self, sample):
+        """
+        Update theta with a new sample, see TrainNg.
+
+        Return (rho, theta, err) where err is the cost of the sample before
+        the update, i.e. the error of predicting it.
+        """
+        ev = CompileEvaluator(sample, self.K, self.solver)
+        err = None
+        C = self.C
+        prior = self.theta
+        theta = prior
+        for i in range(self.iters):
+            r = ev.error(theta)
+            if err is None:
+                err = 0.5 * np.dot(r, r)
+            J = ev.jac(theta)
+            CJ = C.dot(J.T)
+            S = self.forget * np.eye(len(r)) + J.dot(CJ)
+            G = np.linalg.solve(S, CJ.T).T
+            # The residual linearized at theta, seen from the prior
+            step = G.dot(r + J.dot(prior - theta))
+            step = np.clip(step, -self.max_step, self.max_step)
+            theta = np.clip(prior - step, *self.bounds)
+            C_next = (C - G.dot(CJ.T)) / self.forget
+        self.theta = theta
+        # Keep the covariance symmetric against the rounding errors
+        self.C = 0.5 * (C_next + C_next.T)
+        self.updates += 1
+        return Spherical2Cartesian(self.theta), self.theta, err
+
 if __name__ == '__main__':
     # Training phase
     A = np.mat([[1, 1, 0, 0], [1, 0, 0, 1], [0, 1, 1, 0]])
@@ -8,7 +8,7 @@ import time
 import numpy as np
 
 # from estimator import Train, Predict
-from estimator import TrainNg, Predict
+from estimator import Trainer, Predict
 from util.cmd import RED, YELLOW
 
 if __name__ == '__main__':
@@ -29,20 +29,20 @@ if __name__ == '__main__':
     basedir = sys.argv[1]
     filelist = os.listdir(basedir)
 
-    samples = []
     trains = ['test%d-%d-%d' % (K, j, i)
               for j in range(F, 2*F+1)
               for i in range(1, S//2+1)]
 
-    rho, theta = None, None
+    trainer = Trainer(K, custom_gradient=False)
 
     train_out = open('output/train.log', 'w')
     train_time_out = open('output/train-time.log', 'w')
     test_time_out = open('output/test-time.log', 'w')
     train_rho = []
     print(YELLOW('='*30 + ' Train ' + '='*30))
-    for name in trains:
+    for j, name in enumerate(trains):
         print('Reading sample from %s' % name)
+        samples = []
         flow_file = name + '.json'
         rate_file = name + '.mnout'
         if rate_file in filelist:
@@ -54,13 +54,16 @@ if __name__ == '__main__':
 
         print('New sample updated.')
         begin_time = time.time()
-        rho, theta, err = TrainNg(samples, K, theta, custom_gradient=False)
+        # Converge on the cycles used for the predictions below
+        rho, theta, err = trainer.partial_fit(samples,
+                                              final=(j + 1) % (S//2) == 0)
         end_time = time.time()
         train_time_out.write('%f\n' % (end_time - begin_time))
         print('Estimated scaling factor: %s' % rho)
         train_out.write('%s\n' % ' '.join([str(x) for x in rho]))
         train_rho.append(rho)
 
+    trainer.close()
     train_out.close()
     train_time_out.close()
 
@@ -7,7 +7,7 @@ import time
 
 import numpy as np
 
-from estimator import TrainNg
+from estimator import Trainer
 from util.cmd import YELLOW
 
 if __name__ == '__main__':
@@ -23,19 +23,20 @@ if __name__ == '__main__':
     querydirs = os.listdir(basedir)
 
     for i in range(len(querydirs)):
-        samples = []
-        rho, theta = None, None
+        trainer = Trainer(K, custom_gradient=False)
         train_out = open('output.onlytrain/train-%d.log' % i, 'w')
         time_out = open('output.onlytrain/time-%d.log' % i, 'w')
 
-        for query in querydirs[i:] + querydirs[:i]:
+        order = querydirs[i:] + querydirs[:i]
+        for query in order:
             filelist = os.listdir(os.path.join(basedir, query))
             trains = [f[:-5] for f in filelist if f.endswith('.json') and f.startswith('train')]
             trains.sort()
 
             print(YELLOW('='*30 + ' Train ' + '='*30))
-            for name in trains:
+            for j, name in enumerate(trains):
                 print('Reading sample from %s' % name)
+                samples = []
                 flow_file = name + '.json'
                 rate_file = name + '-final.nsout'
                 if rate_file in filelist:
@@ -49,11 +50,13 @@ if __name__ == '__main__':
 
                 print('New sample updated.')
                 begin_time = time.time()
-                rho, theta, err = TrainNg(samples, K, theta, custom_gradient=False)
+                final = query == order[-1] and j == len(trains) - 1
+                rho, theta, err = trainer.partial_fit(samples, final=final)
                 end_time = time.time()
                 print('Estimated scaling factor: %s' % rho)
                 train_out.write('%s\n' % ' '.join([str(x) for x in rho]))
                 time_out.write('%f\n' % (end_time - begin_time))
 
+        trainer.close()
         train_out.close()
         time_out.close()
@@ -8,7 +8,7 @@ import time
 import numpy as np
 
 # from estimator import Train, Predict
-from estimator import TrainNg, Predict
+from estimator import Trainer, Predict
 from util.cmd import RED, YELLOW
 
 if __name__ == '__main__':
@@ -23,8 +23,7 @@ if __name__ == '__main__':
     basedir = sys.argv[1]
     querydirs = os.listdir(basedir)
 
-    samples = []
-    rho, theta = None, None
+    trainer = Trainer(K, custom_gradient=False)
 
     train_out = open('output.query/train.log', 'w')
     train_time_out = open('output.query/train-time.log', 'w')
@@ -37,8 +36,9 @@ if __name__ == '__main__':
         trains.sort()
 
         print(YELLOW('='*30 + ' Train ' + '='*30))
-        for name in trains:
+        for j, name in enumerate(trains):
             print('Reading sample from %s' % name)
+            samples = []
             flow_file = name + '.json'
             rate_file = name + '-final.nsout'
             if rate_file in filelist:
@@ -52,7 +52,9 @@ if __name__ == '__main__':
 
             print('New sample updated.')
             begin_time = time.time()
-            rho, theta, err = TrainNg(samples, K, theta, custom_gradient=False)
+            # Converge before the predictions of this query
+            rho, theta, err = trainer.partial_fit(samples,
+                                                  final=j == len(trains) - 1)
             end_time = time.time()
             train_time_out.write('%f\n' % (end_time - begin_time))
             print('Estimated scaling factor: %s' % rho)
@@ -96,6 +98,7 @@ if __name__ == '__main__':
         test_abs_out.close()
         test_rel_out.close()
 
+    trainer.close()
     train_out.close()
     train_time_out.close()
     test_time_out.close()
@@ -7,7 +7,7 @@ import json
 import numpy as np
 
 # from estimator import Train, Predict
-from estimator import TrainNg, Predict
+from estimator import Trainer, Predict
 from util.cmd import GREEN, RED, YELLOW
 
 if __name__ == '__main__':
@@ -22,16 +22,16 @@ if __name__ == '__main__':
     basedir = sys.argv[1]
     filelist = os.listdir(basedir)
 
-    samples = []
     trains = [f[:-5] for f in filelist if f.endswith('.json') and f.startswith('train')]
     trains.sort()
-    rho, theta = None, None
+    trainer = Trainer(K, custom_gradient=False)
 
     train_out = open('output.train/train.log', 'w')
     train_rho = []
     print(YELLOW('='*30 + ' Train ' + '='*30))
-    for name in trains:
+    for j, name in enumerate(trains):
         print('Reading sample from %s' % name)
+        samples = []
         flow_file = name + '.json'
         rate_file = name + '.nsout'
         # rate_file = name + '-final.nsout'
@@ -45,11 +45,13 @@ if __name__ == '__main__':
         print('New sample updated.')
         # input(GREEN('Continue to train it? (Y/n)'))
         # rho, theta = Train(samples, K, theta)
-        rho, theta, err = TrainNg(samples, K, theta, custom_gradient=False)
+        rho, theta, err = trainer.partial_fit(samples,
+                                              final=j == len(trains) - 1)
         print('Estimated scaling factor: %s' % rho)
         train_out.write('%s\n' % ' '.join([str(x) for x in rho]))
         train_rho.append(rho)
 
+    trainer.close()
     train_out.close()
 
     tests = [f[:-5] for f in filelist if f.endswith('.json') and f.startswith('test')]
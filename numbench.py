@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import random
+import multiprocessing
+
+import numpy as np
+
+from estimator import RoutingMatrix, RhoIndex, PodBlocks, TCP_ALPHA
+from numsolver import solve_num, solve_num_ipm, solve_num_dual
+from admm import ConsensusADMM
+
+def random_flows(F, K, seed=0):
+    r = random.Random(seed)
+    K2 = K//2
+    host = lambda: [r.randrange(K), r.randrange(K2), r.randrange(K2)]
+    flows = []
+    for i in range(F):
+        s = host()
+        d = host()
+        while d == s:
+            d = host()
+        flows.append({'tcp': r.choice(list(TCP_ALPHA.keys())),
+                      'from': s, 'to': d})
+    return flows
+
+# The generic solver needs the dense KKT system, skip it on large problems
+SOLVERS = [('cvxopt', solve_num, 20000),
+           ('ipm', solve_num_ipm, 20000),
+           ('dual', solve_num_dual, None)]
+
+# The numbers of pod blocks of the consensus ADMM, in worker processes and
+# in this process, up to CONSENSUS_FLOWS flows
+CONSENSUS_BLOCKS = [2, 4]
+CONSENSUS_FLOWS = 20000
+
+def solve_consensus(A, c, alpha, rho, blocks, parallel, info=None):
+    solver = ConsensusADMM(A, c, alpha, rho, blocks, parallel=parallel)
+    try:
+        return solver.solve(info=info)
+    finally:
+        solver.close()
+
+def benchmark(F, K, seed=0):
+    flows = random_flows(F, K, seed)
+    A, keys = RoutingMatrix(flows, keys=True)
+    c = np.ones(A.shape[0])
+    alpha = np.array([TCP_ALPHA[f['tcp']] for f in flows], dtype=float)
+    rho_idx = RhoIndex(flows, K)
+    rng = np.random.RandomState(seed)
+    rho = rng.uniform(0.5, 2, max(rho_idx) + 1)
+
+    report = []
+    ref = None
+    for name, solver, max_flows in SOLVERS:
+        if max_flows is not None and F > max_flows:
+            continue
+        info = {}
+        start = time.time()
+        x, la = solver(A, c, alpha, rho[rho_idx], info=info)
+        report.append('%s %.3fs (%d iters)'
+                      % (name, time.time() - start, info['iterations']))
+        if ref is None:
+            ref = x
+        else:
+            report[-1] += ' diff %.1e' % (np.max(np.abs(x - ref)) / np.max(ref))
+        if name == 'ipm':
+            # Re-solve a slightly perturbed problem from the last solution
+            rho_warm = rho * (1 + 0.01 * rng.randn(len(rho)))
+            info = {}
+            start = time.time()
+            solver(A, c, alpha, rho_warm[rho_idx], x0=x, la0=la, info=info)
+            report.append('warm %s %.3fs (%d iters)'
+                          % (name, time.time() - start, info['iterations']))
+
+    for B in CONSENSUS_BLOCKS if F <= CONSENSUS_FLOWS else []:
+        blocks = PodBlocks(A, keys, B)
+        for parallel in [True, False]:
+            info = {}
+            start = time.time()
+            x, la = solve_consensus(A, c, alpha, rho[rho_idx], blocks,
+                                    parallel, info=info)
+            report.append('consensus/%d%s %.3fs (%d iters) diff %.1e'
+                          % (blocks.max() + 1, '' if parallel else ' serial',
+                             time.time() - start, info['iterations'],
+                             np.max(np.abs(x - ref)) / np.max(ref)))
+
+    print('%6d flows %5d links: %s' % (F, A.shape[0], ', '.join(report)))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in ['-h', '--help']:
+        print('%s [K] [F ...]' % sys.argv[0])
+        sys.exit(0)
+
+    K = 32
+    if len(sys.argv) > 1:
+        K = int(sys.argv[1])
+    Fs = [10, 100, 1000, 10000, 100000]
+    if len(sys.argv) > 2:
+        Fs = [int(F) for F in sys.argv[2:]]
+
+    print('%d CPUs' % multiprocessing.cpu_count())
+    for F in Fs:
+        benchmark(F, K)
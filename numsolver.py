@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
-from cvxopt import solvers, matrix, spdiag, log
+from cvxopt import solvers, matrix, spmatrix, spdiag, log
 import numpy as np
+import scipy.sparse as sp
+from scipy.linalg import cho_factor, cho_solve
 from scipy.optimize import fmin_slsqp, least_squares
+from scipy.sparse.linalg import splu
 
-def solve_num(A, c, alpha, rho, niter=100, debug=False):
+def solve_num(A, c, alpha, rho, niter=100, debug=False, x0=None, info=None):
     """
     This function solves the NUM problem.
 
@@ -13,8 +16,17 @@ def solve_num(A, c, alpha, rho, niter=100, debug=False):
 
     The srikant's utility function:
         U(x) = rho * x^(1-alpha) / (1 - alpha)
+
+    x0: the starting point, must be strictly positive (default: all ones)
+    info: if it is a dict, the solver status and the number of iterations
+          are stored in it
     """
-    B = matrix(A, tc='d')
+    if sp.issparse(A):
+        A = A.tocoo()
+        B = spmatrix(A.data.astype(float), A.row.tolist(), A.col.tolist(),
+                     A.shape)
+    else:
+        B = matrix(A, tc='d')
     c = matrix(c, tc='d')
 
     alpha = np.array(alpha)
@@ -28,6 +40,11 @@ def solve_num(A, c, alpha, rho, niter=100, debug=False):
 
     alphas = 1 - alpha
 
+    if x0 is None:
+        x0 = matrix(1.0, (n, 1))
+    else:
+        x0 = matrix(np.array(x0, dtype=float).flatten(), (n, 1))
+
     def f(x):
         y = np.array(x.T).flatten()
         return sum(np.where(alphas==0,
@@ -42,27 +59,491 @@ def solve_num(A, c, alpha, rho, niter=100, debug=False):
         y = np.array(x.T).flatten()
         return z[0] * rho * -alpha * y**(-alpha-1)
 
+    # cvxopt does not report it, count the hessian evaluations instead
+    iterations = [0]
+
     def F(x=None, z=None):
         if x is None:
-            return 0, matrix(1.0, (n, 1))
+            return 0, x0
         if min(x) <= 0.0:
             return None
         fx = matrix(-f(x), (1,1))
         fpx = matrix(-fprime(x), (1, n))
         if z is None:
             return fx, fpx
+        iterations[0] += 1
         fppx = spdiag(matrix(-fpprime(x,z), (n, 1)))
         return fx, fpx, fppx
 
     ret = solvers.cp(F, G=B, h=c, maxiters=niter, options={'show_progress': debug})
+    if info is not None:
+        info['status'] = ret['status']
+        info['iterations'] = iterations[0]
     x, u = ret['x'], ret['zl']
     return np.array(x).flatten(), np.array(u).flatten()
 
-def solve(A, c, alpha, rho, niter=100, debug=False):
+def path_min(AT, v, default=np.inf):
+    """
+    Return the minimum of v / A along the path of each flow, for positive
+    link values v, or default for the flows without links. AT is the
+    transpose of the routing matrix in CSR form.
+    """
+    inv = sp.csr_matrix((AT.data / v[AT.indices], AT.indices, AT.indptr),
+                        shape=AT.shape)
+    inv_max = np.asarray(inv.max(axis=1).todense()).flatten()
+    return np.where(inv_max > 0, 1 / np.where(inv_max > 0, inv_max, 1),
+                    default)
+
+def interior_point(A, c, grad, hess, x0=None, la0=None, niter=100, tol=1e-9,
+                   debug=False, info=None):
+    """
+    A primal-dual interior point method (Mehrotra predictor-corrector) for
+
+        min f(x)
+            Ax <= c, x > 0
+
+    where f is convex and separable, i.e. its hessian is diagonal.
+
+    grad: x -> the gradient of f
+    hess: x -> the diagonal of the hessian of f, must be positive
+    x0, la0: an optional starting point, e.g. the previous solution of a
+             nearby problem
+
+    With the slack s = c - Ax, the newton step reduces to the KxK system
+
+        (A H^-1 A^T + diag(s/la)) dla = rhs
+
+    which is formed from the sparse A and factorized once per iteration.
+
+    Return (x, la).
+    """
+    A = sp.csr_matrix(A, dtype=float)
+    AT = A.T.tocsr()
+    c = np.asarray(c, dtype=float).flatten()
+    m, n = A.shape
+
+    # Starting point: half the fair share of each flow on its tightest link
+    if x0 is not None and len(x0) == n and np.min(x0) > 0:
+        x = np.array(x0, dtype=float).flatten()
+    else:
+        x = 0.5 * path_min(AT, c / np.maximum(A.dot(np.ones(n)), 1), 2)
+    s = c - A.dot(x)
+    shift = 1e-2 * max(np.max(np.abs(c), initial=0), 1)
+    s = np.maximum(s, shift)
+    if la0 is not None and len(la0) == m:
+        la = np.maximum(np.asarray(la0, dtype=float).flatten(), shift)
+    else:
+        la = np.ones(m)
+
+    def factorize(h):
+        # Factorize A H^-1 A^T + diag(s/la), return the solver of the newton
+        # step for the residuals rd = g + A^T la, rp = Ax + s - c and
+        # rc = s * la - sigma * mu.
+        hinv = 1 / h
+        M = A.dot(sp.diags(hinv)).dot(AT) + sp.diags(s / la)
+        if m <= 500 or M.nnz > 0.1 * m * m:
+            # Small or dense enough for a dense cholesky
+            M = M.toarray()
+            try:
+                cho = cho_factor(M)
+                solve_M = lambda b: cho_solve(cho, b)
+            except np.linalg.LinAlgError:
+                solve_M = lambda b: np.linalg.lstsq(M, b, rcond=None)[0]
+        else:
+            # M is symmetric positive definite
+            solve_M = splu(M.tocsc(), permc_spec='MMD_AT_PLUS_A',
+                           diag_pivot_thresh=0,
+                           options={'SymmetricMode': True}).solve
+
+        def newton(rd, rp, rc):
+            dla = solve_M(rp - rc / la - A.dot(hinv * rd))
+            dx = -hinv * (rd + AT.dot(dla))
+            ds = -(rc + s * dla) / la
+            return dx, ds, dla
+        return newton
+
+    def step(v, dv):
+        neg = dv < 0
+        if not np.any(neg):
+            return 1.0
+        return min(1.0, np.min(-v[neg] / dv[neg]))
+
+    status = 'unknown'
+    it = 0
+    for it in range(1, niter + 1):
+        g = grad(x)
+        h = hess(x)
+        rd = g + AT.dot(la)
+        rp = A.dot(x) + s - c
+        mu = np.dot(s, la) / max(m, 1)
+
+        if debug:
+            print('%3d: |rd| = %.3e, |rp| = %.3e, mu = %.3e'
+                  % (it, np.max(np.abs(rd)), np.max(np.abs(rp)), mu))
+        if (np.max(np.abs(rd)) <= tol * (1 + np.max(np.abs(g))) and
+                np.max(np.abs(rp), initial=0) <= tol * (1 + np.max(np.abs(c))) and
+                mu <= tol):
+            status = 'optimal'
+            it -= 1
+            break
+
+        newton = factorize(h)
+
+        # Predictor
+        dx, ds, dla = newton(rd, rp, s * la)
+        a = min(step(x, dx), step(s, ds), step(la, dla))
+        mu_aff = np.dot(s + a * ds, la + a * dla) / max(m, 1)
+        sigma = (mu_aff / mu) ** 3 if mu > 0 else 0
+        # Keep mu from collapsing while the dual residual is still large,
+        # otherwise the iterates stall on the boundary
+        sigma = max(sigma, min(0.5, np.max(np.abs(rd)) / (1 + np.max(np.abs(g)))))
+
+        # Corrector
+        dx, ds, dla = newton(rd, rp, s * la + ds * dla - sigma * mu)
+        a = 0.99 * min(step(x, dx), step(s, ds), step(la, dla))
+        x = x + a * dx
+        s = s + a * ds
+        la = la + a * dla
+
+    if info is not None:
+        info['status'] = status
+        info['iterations'] = it
+    return x, la
+
+def solve_num_ipm(A, c, alpha, rho, niter=100, debug=False, x0=None, la0=None,
+                  tol=1e-9, info=None):
+    """
+    Solve the same NUM problem as solve_num with interior_point, exploiting
+    the diagonal hessian of the utilities and the sparsity of A.
+
+    x0, la0: an optional primal/dual starting point
+    """
+    alpha = np.asarray(alpha, dtype=float)
+    rho = np.asarray(rho, dtype=float)
+    m, n = A.shape
+
+    assert n == len(alpha)
+    assert n == len(rho)
+    assert m == len(c)
+
+    grad = lambda x: -rho * np.power(x, -alpha)
+    hess = lambda x: rho * alpha * np.power(x, -alpha-1)
+    return interior_point(A, c, grad, hess, x0, la0, niter, tol, debug, info)
+
+def solve_num_dual(A, c, alpha, rho, niter=10000, debug=False, la0=None,
+                   tol=1e-6, info=None):
+    """
+    Solve the same NUM problem as solve_num in the dual, for very large
+    numbers of flows.
+
+    Given the link prices la, the best response of flow j is closed-form,
+
+        x_j = min((rho_j / q_j)^(1/alpha_j), xmax_j),  q = A^T la
+
+    where xmax_j is the smallest capacity on its path, divided by its
+    coefficient in A, so the dual function is minimized over la >= 0 by
+    accelerated projected gradient (FISTA with backtracking and adaptive
+    restart). An iteration costs a few products with the sparse A and the
+    memory is linear in nnz(A).
+
+    la0: optional starting prices, e.g. the prices of a nearby problem
+    tol: the tolerance on the relative infeasibility and duality gap
+
+    Return (x, la).
+    """
+    A = sp.csr_matrix(A, dtype=float)
+    AT = A.T.tocsr()
+    c = np.asarray(c, dtype=float).flatten()
+    alpha = np.asarray(alpha, dtype=float)
+    rho = np.asarray(rho, dtype=float)
+    m, n = A.shape
+
+    assert n == len(alpha)
+    assert n == len(rho)
+    assert m == len(c)
+
+    log_mask = alpha == 1
+    inv_alpha = 1 / alpha
+    power = np.where(log_mask, 0, 1 - alpha)
+    log_rho = np.log(rho)
+    log_xmax = np.log(path_min(AT, c))
+    A2 = A.multiply(A).tocsr()
+
+    def utility(log_x):
+        with np.errstate(invalid='ignore', over='ignore'):
+            return rho * np.where(log_mask, log_x,
+                                  np.exp(power * log_x) / np.where(log_mask, 1,
+                                                                   power))
+
+    def dual(la):
+        # The dual function, its gradient c - Ax, the best response and the
+        # diagonal of the dual hessian A diag(-dx/dq) A^T
+        q = AT.dot(la)
+        with np.errstate(divide='ignore'):
+            log_x = (log_rho - np.log(q)) * inv_alpha
+        free = log_x < log_xmax
+        log_x = np.where(free, log_x, log_xmax)
+        x = np.exp(log_x)
+        # The capped flows keep the curvature at the cap, as if smoothed
+        h = A2.dot(np.where(q > 0, x * inv_alpha / np.where(q > 0, q, 1), 0))
+        return (np.sum(utility(log_x)) - np.dot(q, x) + np.dot(la, c),
+                c - A.dot(x), x, log_x, h)
+
+    # Start from the prices at which each flow gets its fair share
+    if la0 is not None and len(la0) == m:
+        la = np.maximum(np.asarray(la0, dtype=float).flatten(), 0)
+    else:
+        hops = np.maximum(AT.dot(np.ones(m)), 1)
+        x = path_min(AT, c / np.maximum(A.dot(np.ones(n)), 1), 1)
+        la = A.dot(rho * np.power(x, -alpha) / hops) / \
+            np.maximum(A.dot(np.ones(n)), 1)
+    cmax = np.max(np.abs(c), initial=1)
+
+    L = 1.0
+    t = 1.0
+    y = la
+    d_y, g_y, x, log_x, h_y = dual(y)
+    d_prev = d_y
+    status = 'unknown'
+    it = 0
+    for it in range(1, niter + 1):
+        # Scale the steps by the diagonal of the dual hessian, and backtrack
+        # on the remaining Lipschitz constant
+        D = np.maximum(h_y, 1e-12 * max(np.max(h_y, initial=0), 1e-12))
+        while True:
+            la_new = np.maximum(y - g_y / (L * D), 0)
+            diff = la_new - y
+            d_new, g_new, x, log_x, h_new = dual(la_new)
+            if d_new <= d_y + np.dot(g_y, diff) + \
+                    0.5 * L * np.dot(diff, D * diff) + 1e-12 * abs(d_y):
+                break
+            L *= 2
+        L = max(0.9 * L, 1e-3)
+
+        # Duality gap with the best response scaled into the feasible set
+        load = c - g_new
+        infeas = np.max(load - c, initial=0) / cmax
+        scale = np.min(np.where(load > 0, c / np.where(load > 0, load, 1),
+                                np.inf), initial=np.inf)
+        primal = np.sum(utility(log_x + np.log(min(scale, 1))))
+        gap = (d_new - primal) / max(abs(d_new), 1)
+        if debug:
+            print('%5d: dual = %.6e, infeas = %.3e, gap = %.3e'
+                  % (it, d_new, infeas, gap))
+        if infeas <= tol and gap <= tol:
+            la = la_new
+            status = 'optimal'
+            break
+
+        # Adaptive restart when the dual objective goes up
+        if d_new > d_prev:
+            t = 1.0
+            y = la_new
+            d_y, g_y, h_y = d_new, g_new, h_new
+        else:
+            t_next = (1 + np.sqrt(1 + 4 * t * t)) / 2
+            y = np.maximum(la_new + (t - 1) / t_next * (la_new - la), 0)
+            t = t_next
+            d_y, g_y, _, _, h_y = dual(y)
+        la, d_prev = la_new, d_new
+
+    if info is not None:
+        info['status'] = status
+        info['iterations'] = it
+    return x, la
+
+def link_prices(rows, a, b, rho, alpha, c, niter=100, tol=1e-12):
+    """
+    Find the price la_l >= 0 of each link such that its flows fill it,
+
+        sum_{j on l} a_j x_j = c_l,  x_j = (rho_j / (b_j + a_j la_l))^(1/alpha_j)
+
+    where b_j is the price the flow already pays on its other links, or
+    la_l = 0 if the flows fit at that price. The left hand side is convex
+    and decreasing in la_l, so newton's method from the right of the root
+    lands on its left and then increases monotonically to it. A bisection
+    step is taken whenever newton leaves the bracket.
+
+    rows, a: the link and the coefficient of each (link, flow) entry, a flow
+             must be on one of the links at most
+    b, rho, alpha: the values of the flow of each entry
+
+    Return (la, iterations, converged).
+    """
+    m = len(c)
+    done = np.zeros(m, dtype=bool)
+
+    # The links which are not full at la = 0
+    lo = np.zeros(m)
+    with np.errstate(divide='ignore'):
+        x = np.power(rho / b, 1 / alpha)
+    fill = np.bincount(rows, a * x, m)
+    done[fill <= c] = True
+    # and where every flow gets at most c_l/n_l
+    n = np.bincount(rows, minlength=m)
+    hi = np.zeros(m)
+    np.maximum.at(hi, rows, rho / a * np.power(a * n[rows] / c[rows], alpha))
+    la = hi.copy()
+    la[done] = 0
+
+    it = 0
+    for it in range(1, niter + 1):
+        q = b + a * la[rows]
+        with np.errstate(divide='ignore'):
+            x = np.power(rho / q, 1 / alpha)
+            dx = -a * x / (alpha * q)
+        f = np.bincount(rows, a * x, m) - c
+        df = np.bincount(rows, a * dx, m)
+        done |= np.abs(f) <= tol * c
+        if np.all(done):
+            break
+        lo = np.where(f > 0, la, lo)
+        hi = np.where(f < 0, la, hi)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = la - f / df
+        bisect = ~np.isfinite(step) | (step <= lo) | (step >= hi)
+        step = np.where(bisect, 0.5 * (lo + hi), step)
+        done |= hi - lo <= tol * hi
+        la = np.where(done, la, step)
+    return la, it, bool(np.all(done))
+
+def solve_num_link(A, c, alpha, rho, debug=False, info=None):
+    """
+    Solve the same NUM problem as solve_num when every flow crosses one
+    link at most, e.g. a single bottleneck or a batch of them. The price of
+    each link is the root of a scalar equation, see link_prices, and all
+    the links are solved at once. The flows without any link are
+    unbounded and get inf.
+
+    Return (x, la).
+    """
+    A = sp.csc_matrix(A, dtype=float)
+    c = np.asarray(c, dtype=float).flatten()
+    alpha = np.asarray(alpha, dtype=float)
+    rho = np.asarray(rho, dtype=float)
+    m, n = A.shape
+
+    assert n == len(alpha)
+    assert n == len(rho)
+    assert m == len(c)
+    hops = np.diff(A.indptr)
+    assert np.all(hops <= 1)
+
+    flows = np.flatnonzero(hops)
+    rows = A.indices
+    a = A.data
+    la, it, converged = link_prices(rows, a, np.zeros(len(flows)),
+                                    rho[flows], alpha[flows], c)
+    x = np.full(n, np.inf)
+    x[flows] = np.power(rho[flows] / (a * la[rows]), 1 / alpha[flows])
+    if debug:
+        print('%d links solved in %d iterations' % (m, it))
+
+    if info is not None:
+        info['status'] = 'optimal' if converged else 'unknown'
+        info['iterations'] = it
+    return x, la
+
+def solve_num_chain(A, c, alpha, rho, niter=100, debug=False, la0=None,
+                    tol=1e-9, info=None):
+    """
+    Solve the same NUM problem as solve_num by projected newton steps on the
+    dual function, for a few links such as a chain. The dual variable is
+    the vector of link prices, so a step only factorizes a dense KxK
+    hessian A diag(-dx/dq) A^T, and it takes fewer steps than the interior
+    point method as there is no barrier to follow. It starts from the
+    prices of the links alone, see link_prices, and the links with a zero
+    price and a slack capacity are kept at zero.
+
+    la0: optional starting prices, e.g. the prices of a nearby problem
+    tol: the tolerance on the relative infeasibility and slackness
+
+    Return (x, la).
+    """
+    A = sp.csr_matrix(A, dtype=float)
+    c = np.asarray(c, dtype=float).flatten()
+    alpha = np.asarray(alpha, dtype=float)
+    rho = np.asarray(rho, dtype=float)
+    m, n = A.shape
+
+    assert n == len(alpha)
+    assert n == len(rho)
+    assert m == len(c)
+
+    # The flows without any link are unbounded
+    x = np.full(n, np.inf)
+    flows = np.flatnonzero(np.diff(A.tocsc().indptr))
+    A = A[:, flows]
+    AT = A.T.tocsr()
+    alpha = alpha[flows]
+    rho = rho[flows]
+    log_mask = alpha == 1
+    power = np.where(log_mask, 0, 1 - alpha)
+
+    def dual(la):
+        # The dual function, its gradient c - Ax and the best response
+        q = AT.dot(la)
+        if np.any(q <= 0):
+            return np.inf, None, None, None
+        x = np.power(rho / q, 1 / alpha)
+        u = np.where(log_mask, np.log(x),
+                     np.power(x, power) / np.where(log_mask, 1, power))
+        return np.dot(rho, u) - np.dot(q, x) + np.dot(c, la), c - A.dot(x), x, q
+
+    if la0 is not None and len(la0) == m and np.all(AT.dot(la0) > 0):
+        la = np.maximum(np.asarray(la0, dtype=float).flatten(), 0)
+    else:
+        C = A.tocoo()
+        la = link_prices(C.row, C.data, np.zeros(C.nnz), rho[C.col],
+                         alpha[C.col], c)[0]
+    d, g, xf, q = dual(la)
+
+    status = 'unknown'
+    it = 0
+    for it in range(1, niter + 1):
+        r = -g / c
+        zero = la * c <= tol * np.dot(la, c)
+        err = np.max(np.where(zero, np.maximum(r, 0), np.abs(r)), initial=0)
+        if debug:
+            print('%3d: dual = %.6e, residual = %.3e' % (it, d, err))
+        if err <= tol:
+            status = 'optimal'
+            it -= 1
+            break
+
+        H = A.multiply(xf / (alpha * q)).dot(AT).toarray()
+        fixed = (la <= 0) & (g > 0)
+        free = ~fixed
+        step = np.zeros(m)
+        step[fixed] = -g[fixed] / np.maximum(np.diag(H)[fixed], 1e-300)
+        H = H[np.ix_(free, free)]
+        try:
+            step[free] = -cho_solve(cho_factor(H), g[free])
+        except np.linalg.LinAlgError:
+            # Links with the same flows share their price arbitrarily
+            step[free] = -np.linalg.lstsq(H, g[free], rcond=None)[0]
+
+        # Armijo backtracking along the projection arc
+        t = 1.0
+        while t > 1e-12:
+            la_new = np.maximum(la + t * step, 0)
+            d_new, g_new, x_new, q_new = dual(la_new)
+            if d_new <= d + 1e-4 * np.dot(g, la_new - la) + 1e-12 * abs(d):
+                la, d, g, xf, q = la_new, d_new, g_new, x_new, q_new
+                break
+            t *= 0.5
+
+    x[flows] = xf
+    if info is not None:
+        info['status'] = status
+        info['iterations'] = it
+    return x, la
+
+def solve(A, c, alpha, rho, niter=100, debug=False, x0=None, info=None):
     """
     For backward compatibility
     """
-    return solve_num(A, c, alpha, rho, niter, debug)
+    return solve_num(A, c, alpha, rho, niter, debug, x0, info)
 
 def train(samples, A, c, alpha):
     m, n = A.shape